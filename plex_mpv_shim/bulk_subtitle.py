@@ -1,9 +1,9 @@
-from .media import XMLCollection
-from .utils import get_plex_url
+from .cache import metadataCache
+from .media import XMLCollection, StreamTable
+from .utils import plex_request
 
 from collections import namedtuple
 import urllib.parse
-import requests
 import time
 import logging
 
@@ -39,11 +39,12 @@ def process_series(mode, url, player, m_raid=None, m_rsid=None):
         video = XMLCollection(xml.get_path(video.get("key"))).tree.find("./")
         for partxml in video.findall("./Media/Part"):
             count += 1
+            streams = StreamTable(partxml)
             audio_list = [Audio(s.get("id"), s.get("languageCode"), s.get("title"),
-                          s.get("displayTitle")) for s in partxml.findall("./Stream[@streamType='2']")]
+                          s.get("displayTitle")) for s in streams.audio]
             subtitle_list =  [Subtitle(s.get("id"), s.get("languageCode"), s.get("title"),
                               "Forced" in s.get("displayTitle"), s.get("displayTitle"))
-                              for s in partxml.findall("./Stream[@streamType='3']")]
+                              for s in streams.subtitles]
             part = Part(partxml.get("id"), audio_list, subtitle_list)
 
             aid = None
@@ -89,7 +90,7 @@ def process_series(mode, url, player, m_raid=None, m_rsid=None):
                     "subtitleStreamID": sid
                 }
                 url = "/library/parts/{0}".format(part.id)
-                requests.put(get_plex_url(urllib.parse.urljoin(xml.server_url, url), args), data=None)
+                plex_request("PUT", urllib.parse.urljoin(xml.server_url, url), args)
             else:
                 render_message("{0}: Fail".format(name), show_text)
     
@@ -102,6 +103,7 @@ def process_series(mode, url, player, m_raid=None, m_rsid=None):
     elif mode == "manual":
         render_message("Manual: {0} ok, {1} fail".format(
             success_ct, count-success_ct), show_text)
+    metadataCache.invalidate(xml.server_url)
     time.sleep(3)
     if c_aid:
         render_message("Setting Current...", show_text)
@@ -0,0 +1,117 @@
+"""
+cache.py - Plex Metadata Cache
+
+Keeps recently fetched Plex documents in memory so that moving between
+items of a series or play queue does not download and parse the same XML
+again. Entries are keyed by URL (without the token) and expire based on
+the endpoint. Expired entries are revalidated using ETag/Last-Modified.
+"""
+import logging
+import re
+import time
+import urllib.parse
+from collections import OrderedDict
+from threading import Lock
+
+from .conf import settings
+from .utils import plex_request, PLEX_TOKEN_RE
+
+log = logging.getLogger('cache')
+
+# Seconds a cached document is used without asking the server.
+# The first pattern matching the URL path wins.
+CACHE_TTLS = (
+    (re.compile(r"/(allLeaves|children)$"),     300),
+    (re.compile(r"^/library/metadata/"),        60),
+)
+DEFAULT_CACHE_TTL = 30
+
+def get_cache_key(url):
+    return re.sub(PLEX_TOKEN_RE, "\\1=", url)
+
+def get_ttl(path):
+    for pattern, ttl in CACHE_TTLS:
+        if pattern.search(path):
+            return ttl
+    return DEFAULT_CACHE_TTL
+
+class CacheEntry(object):
+    __slots__ = ("url", "value", "etag", "last_modified", "expires")
+
+    def __init__(self, url, value, response):
+        self.url            = url
+        self.value          = value
+        self.etag           = response.headers.get("ETag")
+        self.last_modified  = response.headers.get("Last-Modified")
+        self.expires        = time.monotonic() + get_ttl(urllib.parse.urlsplit(url).path)
+
+class MetadataCache(object):
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def fetch(self, url, parser, stream=False):
+        """
+        Returns ``parser(response)`` for ``url``. Fresh entries are returned
+        without a request. Stale entries are revalidated with the server, and
+        are reused without parsing again if the server answers 304.
+
+        If ``stream`` is set, the body is not read ahead of time and the
+        parser is expected to consume ``response.raw`` itself.
+        """
+        if not settings.metadata_cache_size:
+            return self.load(url, parser, stream)
+
+        key = (parser, get_cache_key(url))
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+
+        if entry is not None and entry.expires > time.monotonic():
+            return entry.value
+
+        headers = {}
+        if entry is not None:
+            if entry.etag:
+                headers["If-None-Match"] = entry.etag
+            if entry.last_modified:
+                headers["If-Modified-Since"] = entry.last_modified
+
+        response = plex_request("GET", url, headers=headers, stream=stream)
+        with response:
+            if entry is not None and response.status_code == 304:
+                log.debug("MetadataCache::fetch revalidated %s" % entry.url)
+                entry.expires = time.monotonic() + get_ttl(urllib.parse.urlsplit(url).path)
+                return entry.value
+
+            response.raise_for_status()
+            value = parser(response)
+
+        with self.lock:
+            self.entries[key] = CacheEntry(key[1], value, response)
+            self.entries.move_to_end(key)
+            while len(self.entries) > settings.metadata_cache_size:
+                self.entries.popitem(last=False)
+        return value
+
+    def load(self, url, parser, stream=False):
+        with plex_request("GET", url, stream=stream) as response:
+            response.raise_for_status()
+            return parser(response)
+
+    def invalidate(self, url_prefix=None):
+        """
+        Drops every entry whose URL starts with ``url_prefix``, or all
+        entries if no prefix is given.
+        """
+        with self.lock:
+            if url_prefix is None:
+                self.entries.clear()
+                return
+
+            url_prefix = get_cache_key(url_prefix)
+            for key in [key for key in self.entries if key[1].startswith(url_prefix)]:
+                del self.entries[key]
+
+metadataCache = MetadataCache()
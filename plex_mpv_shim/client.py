@@ -8,6 +8,7 @@ import threading
 import urllib.request, urllib.parse, urllib.error
 import urllib.parse
 import socket
+from functools import partial
 from time import mktime
 from email.utils import formatdate
 
@@ -15,7 +16,7 @@ from http.server import HTTPServer
 from http.server import SimpleHTTPRequestHandler
 from socketserver import ThreadingMixIn
 from .media import MediaType
-from .utils import upd_token, sanitize_msg, plex_color_to_mpv
+from .utils import upd_token, warm_local_domain, sanitize_msg, plex_color_to_mpv
 from .conf import settings
 
 try:
@@ -26,9 +27,9 @@ except:
 from io import BytesIO
 
 from .conf import settings
-from .media import Media
+from .play_pipeline import playPipeline, play_media
 from .player import playerManager
-from .subscribers import remoteSubscriberManager, RemoteSubscriber
+from .subscribers import remoteSubscriberManager, RemoteSubscriber, pollWaiters
 from .timeline import timelineManager
 
 log = logging.getLogger("client")
@@ -45,8 +46,40 @@ NAVIGATION_DICT = {
     "/player/navigation/back": "back"
 }
 
+def get_response_headers(length):
+    # https://stackoverflow.com/questions/225086/
+    now = datetime.datetime.now()
+    stamp = mktime(now.timetuple())
+    return [
+        ("Access-Control-Allow-Origin",     "*"),
+        ("Access-Control-Expose-Headers",   "X-Plex-Client-Identifier"),
+        ("X-Plex-Client-Identifier",        settings.client_uuid),
+        ("Content-type",                    "text/xml"),
+        ("Date",                            formatdate(timeval=stamp, localtime=False, usegmt=True)),
+        ("Content-Length",                  str(length)),
+    ]
+
+def send_parked_response(request, xmlData):
+    """
+    Answers a request whose handler has already returned, such as a long
+    poll, and closes its connection.
+    """
+    headers = get_response_headers(len(xmlData)) + [("Connection", "close")]
+    head = "HTTP/1.0 200 OK\r\n" + "".join("%s: %s\r\n" % header for header in headers) + "\r\n"
+    try:
+        request.sendall(head.encode("latin-1") + xmlData)
+    except OSError:
+        log.debug("send_parked_response client went away")
+    finally:
+        try:
+            request.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+        request.close()
+
 class HttpHandler(SimpleHTTPRequestHandler):
     xmlOutput   = None
+    rawOutput   = None
     completed   = False
     
     handlers    = (
@@ -202,31 +235,21 @@ class HttpHandler(SimpleHTTPRequestHandler):
         if self.completed:
             return
 
-        response = BytesIO()
-        tree     = et.ElementTree(self.xmlOutput)
-        tree.write(response, encoding="utf-8", xml_declaration=True)
-        response.seek(0)
+        if self.rawOutput is not None:
+            xmlData = self.rawOutput
+        else:
+            response = BytesIO()
+            tree     = et.ElementTree(self.xmlOutput)
+            tree.write(response, encoding="utf-8", xml_declaration=True)
+            response.seek(0)
 
-        xmlData = response.read()
+            xmlData = response.read()
 
         self.send_response(200)
 
-        self.send_header("Access-Control-Allow-Origin", "*")
-        self.send_header("Access-Control-Expose-Headers", "X-Plex-Client-Identifier")
-        self.send_header("X-Plex-Client-Identifier",    settings.client_uuid)
-        self.send_header("Content-type", "text/xml")
-        
-        # https://stackoverflow.com/questions/225086/
-        now = datetime.datetime.now()
-        stamp = mktime(now.timetuple())
-        self.send_header("Date", formatdate(
-            timeval=stamp,
-            localtime=False,
-            usegmt=True
-        ))
-        
-        self.send_header("Content-Length", str(len(xmlData)))
-        
+        for header in get_response_headers(len(xmlData)):
+            self.send_header(*header)
+
         self.end_headers()
 
         self.wfile.write(xmlData)
@@ -244,7 +267,7 @@ class HttpHandler(SimpleHTTPRequestHandler):
             
             self.send_end()
 
-            timelineManager.SendTimelineToSubscriber(sub)
+            timelineManager.QueueTimelineForSubscriber(sub)
 
     def unsubscribe(self, path, arguments):
         remoteSubscriberManager.removeSubscriber(self.getSubFromRequest(arguments))
@@ -268,9 +291,13 @@ class HttpHandler(SimpleHTTPRequestHandler):
         remoteSubscriberManager.addSubscriber(pollSubscriber)
 
         if "wait" in arguments and arguments["wait"] in ("1", "true"):
-            self.xmlOutput = timelineManager.WaitForTimeline(pollSubscriber)
+            # The socket is answered when the next timeline is published,
+            # so the poll does not keep this thread waiting.
+            self.completed = True
+            self.close_connection = True
+            pollWaiters.park(self.request, uuid, commandID, partial(send_parked_response, self.request))
         else:
-            self.xmlOutput = timelineManager.GetCurrentTimeLinesXML(pollSubscriber)
+            self.rawOutput = timelineManager.GetCurrentTimeLinesXML(commandID)
 
     def resources(self, path, arguments):
         mediaContainer = et.Element("MediaContainer")
@@ -312,23 +339,17 @@ class HttpHandler(SimpleHTTPRequestHandler):
         token = arguments.get("token", None)
         if token:
             upd_token(address, token)
+            warm_local_domain(address)
 
-        if settings.enable_play_queue and playQueue.startswith("/playQueue"):
-            media = Media(url, media_type=parsed_media_type, play_queue=playQueue)
-        else:
-            media = Media(url, media_type=parsed_media_type)
+        if not (settings.enable_play_queue and playQueue and playQueue.startswith("/playQueue")):
+            playQueue = None
 
-        log.debug("HttpHandler::playMedia %s" % media)
-
-        # TODO: Select video, media and part here based off user settings
-        media_item = media.get_media_item(0)
-        if media_item:
-            if settings.pre_media_cmd:
-                os.system(settings.pre_media_cmd)
-            playerManager.play(media_item, offset)
-            timelineManager.SendTimelineToSubscribers()
+        # The remote is answered now; the item is loaded and played by the
+        # pipeline, which drops it if another play arrives first.
+        playPipeline.submit(play_media, url, parsed_media_type, playQueue, offset)
 
     def stop(self, path, arguments):
+        playPipeline.cancel()
         playerManager.stop()
         timelineManager.SendTimelineToSubscribers()
 
@@ -351,7 +372,7 @@ class HttpHandler(SimpleHTTPRequestHandler):
         playerManager.seek(offset)
 
     def skipTo(self, path, arguments):
-        playerManager.skip_to(arguments["key"])
+        playerManager.skip_to(arguments["key"], arguments.get("playQueueItemID"))
 
     def set(self, path, arguments):
         if "volume" in arguments:
@@ -400,6 +421,11 @@ class HttpHandler(SimpleHTTPRequestHandler):
 class HttpSocketServer(ThreadingMixIn, HTTPServer):
     allow_reuse_address = True
 
+    def shutdown_request(self, request):
+        # Parked long polls are closed once they are answered.
+        if not pollWaiters.is_parked(request):
+            super().shutdown_request(request)
+
 class HttpServer(threading.Thread):
     def __init__(self, port):
         super(HttpServer, self).__init__(name="HTTP Server")
@@ -30,6 +30,7 @@ class Settings(object):
         "always_transcode":     False,
         "auto_transcode":       True,
         "adaptive_transcode":   False,
+        "sidecar_subtitles":    False,
         "direct_limit":         False,
         "transcode_kbps":       2000,
         "client_profile":       "Plex Home Theater",
@@ -81,6 +82,14 @@ class Settings(object):
         "svp_socket":           None,
         "shader_pack_subtype":  "lq",
         "menu_mouse":           True,
+        "http_connect_timeout": 5,
+        "http_read_timeout":    30,
+        "metadata_cache_size":  64,
+        "prefetch_next":        True,
+        "prefetch_percent":     75,
+        "gapless_playback":     False,
+        "plex_identity_headers": False,
+        "timeline_heartbeat":   5,
     }
 
     def __getattr__(self, name):
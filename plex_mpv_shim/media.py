@@ -3,27 +3,175 @@ from enum import Enum
 import logging
 import urllib.request, urllib.parse, urllib.error
 import urllib.parse
-import certifi
-import requests
 import uuid
-import ssl
+import time
+
+from bisect import bisect_right
+from threading import Lock
 
 try:
     import xml.etree.cElementTree as et
 except:
     import xml.etree.ElementTree as et
 
+from .cache import metadataCache
 from .conf import settings
-from .utils import get_plex_url, safe_urlopen, is_local_domain, get_transcode_session, clear_transcode_session, sanitize_msg
+from .servers import serverRegistry
+from .utils import (get_plex_url, plex_request, safe_urlopen, is_local_domain, get_transcode_session,
+                    set_transcode_session, clear_transcode_session, sanitize_msg, get_http_session, get_http_timeout, get_plex_headers)
 
 log = logging.getLogger('media')
 
+# Seconds a direct play decision is reused while the request is unchanged.
+DECISION_CACHE_TTL = 120
+decision_cache = {}
+decision_cache_lock = Lock()
+
+# Number of play queue items fetched on each side of the current item.
+PLAY_QUEUE_WINDOW = 50
+# The window is moved once the current item is this close to its edge.
+PLAY_QUEUE_MARGIN = 2
+
 # http://192.168.0.12:32400/photo/:/transcode?url=http%3A%2F%2F127.0.0.1%3A32400%2F%3A%2Fresources%2Fvideo.png&width=75&height=75
 
 class MediaType(Enum):
     VIDEO = "video"
     MUSIC = "music"
 
+# Subtitle codecs mpv renders itself when they are loaded next to a
+# transcode instead of being burned in.
+TEXT_SUBTITLE_CODECS = {"srt", "subrip", "ass", "ssa", "vtt", "webvtt", "smi", "mov_text", "txt"}
+
+class StreamTable(object):
+    """
+    Index of the streams of a media part, built in a single pass over the
+    part's ``<Stream>`` elements. mpv numbers audio and subtitle tracks in
+    the order Plex lists them, which is what the ``*_seq`` maps hold.
+    External subtitles are loaded separately, so they have no mpv number.
+    """
+    def __init__(self, part_node=None):
+        self.audio              = []
+        self.subtitles          = []
+        self.by_id              = {}
+        self.audio_seq          = {}
+        self.audio_uid          = {}
+        self.subtitle_seq       = {}
+        self.subtitle_uid       = {}
+        self.selected_audio     = None
+        self.selected_subtitle  = None
+
+        if part_node is None:
+            return
+
+        for stream in part_node.iterfind("./Stream"):
+            stream_id = stream.get("id")
+            stream_type = stream.get("streamType")
+            is_selected = stream.get("selected") == "1"
+            self.by_id[stream_id] = stream
+
+            if stream_type == "2":
+                self.audio.append(stream)
+                self.audio_uid[len(self.audio)] = stream_id
+                self.audio_seq[stream_id] = len(self.audio)
+                if is_selected and self.selected_audio is None:
+                    self.selected_audio = stream
+            elif stream_type == "3":
+                self.subtitles.append(stream)
+                if stream.get("key") is None:
+                    self.subtitle_uid[len(self.subtitles)] = stream_id
+                    self.subtitle_seq[stream_id] = len(self.subtitles)
+                if is_selected and self.selected_subtitle is None:
+                    self.selected_subtitle = stream
+
+    def is_external(self, stream_id):
+        stream = self.by_id.get(stream_id)
+        return stream is not None and stream.get("key") is not None
+
+    def get_selected_audio_id(self):
+        if self.selected_audio is not None:
+            return self.selected_audio.get("id")
+
+    def get_selected_subtitle_id(self):
+        if self.selected_subtitle is not None:
+            return self.selected_subtitle.get("id")
+
+class MarkerIndex(object):
+    """
+    Every marker and chapter of an item, kept sorted by start time per type
+    so the marker around a playback position and the next time a marker
+    begins or ends can be found with a binary search. Times are in seconds.
+    Chapters are stored under the ``chapter`` type.
+    """
+    def __init__(self, node=None):
+        self.starts = {}
+        self.ends   = {}
+
+        if node is None:
+            return
+
+        markers = {}
+        for marker in node.iterfind("./Marker"):
+            self.add(markers, marker.get("type"), marker)
+        for chapter in node.iterfind("./Chapter"):
+            self.add(markers, "chapter", chapter)
+
+        for marker_type, times in markers.items():
+            times.sort()
+            self.starts[marker_type] = [start for start, end in times]
+            self.ends[marker_type]   = [end for start, end in times]
+            log.info("{0} {1} marker(s) detected: {2}".format(len(times), marker_type,
+                     ", ".join("{0} - {1}".format(start, end) for start, end in times)))
+
+    @staticmethod
+    def add(markers, marker_type, node):
+        try:
+            start = float(node.get("startTimeOffset")) / 1e3
+            end = float(node.get("endTimeOffset")) / 1e3
+        except (TypeError, ValueError):
+            log.error("Could not parse {0} marker.".format(marker_type), exc_info=True)
+            return
+        if marker_type is not None and end > start:
+            markers.setdefault(marker_type, []).append((start, end))
+
+    def first(self, marker_type):
+        if marker_type in self.starts:
+            return self.starts[marker_type][0], self.ends[marker_type][0]
+        return None, None
+
+    def find(self, marker_type, time):
+        """
+        Returns ``(start, end)`` of the ``marker_type`` marker containing
+        ``time``, or ``None`` if there is none.
+        """
+        starts = self.starts.get(marker_type)
+        if not starts:
+            return None
+        idx = bisect_right(starts, time) - 1
+        if idx >= 0 and time < self.ends[marker_type][idx]:
+            return starts[idx], self.ends[marker_type][idx]
+        return None
+
+    def next_boundary(self, time, marker_types):
+        """
+        Returns the first time after ``time`` where a marker of one of
+        ``marker_types`` starts or ends, or ``None`` if there is none.
+        """
+        boundary = None
+        for marker_type in marker_types:
+            starts = self.starts.get(marker_type)
+            if not starts:
+                continue
+            idx = bisect_right(starts, time)
+            if idx > 0 and time < self.ends[marker_type][idx - 1]:
+                candidate = self.ends[marker_type][idx - 1]
+            elif idx < len(starts):
+                candidate = starts[idx]
+            else:
+                continue
+            if boundary is None or candidate < boundary:
+                boundary = candidate
+        return boundary
+
 class MediaItem(ABC):
     def __init__(self, media_type, node, parent):
         self.media_type = media_type
@@ -38,6 +186,12 @@ class MediaItem(ABC):
     def is_multipart(self):
         pass
 
+    def prefetch(self):
+        """
+        Does any server round trips needed to start playback ahead of time.
+        """
+        pass
+
     def get_duration(self):
         return self.node.get("duration")
 
@@ -71,6 +225,7 @@ class MediaItem(ABC):
         }
 
         self.played = safe_urlopen(url, data)
+        metadataCache.invalidate(self.parent.server_url)
         return self.played
 
 class Video(MediaItem):
@@ -81,6 +236,7 @@ class Video(MediaItem):
         self._media_node   = None
         self._part         = 0
         self._part_node    = None
+        self.streams       = StreamTable()
         self.subtitle_seq  = {}
         self.subtitle_uid  = {}
         self.audio_seq     = {}
@@ -89,10 +245,10 @@ class Video(MediaItem):
         self.trs_aid       = None
         self.trs_sid       = None
         self.trs_ovr       = None
-        self.intro_start   = None
-        self.intro_end     = None
-        self.credits_start = None
-        self.credits_end   = None
+        self.burn_subs     = True
+        self.prefetch_url  = None
+        self.prefetch_key  = None
+        self._markers      = None
 
         if media:
             self.select_media(media, part)
@@ -100,49 +256,85 @@ class Video(MediaItem):
         if not self._media_node:
             self.select_best_media(part)
 
-        try:
-            marker = self.node.find("./Marker[@type='intro']")
-            if marker is not None:
-                self.intro_start = float(marker.get('startTimeOffset')) / 1e3
-                self.intro_end = float(marker.get('endTimeOffset')) / 1e3
-                log.info("Intro Detected: {0} - {1}".format(self.intro_start, self.intro_end))
-        except:
-            log.error("Could not detect intro.", exc_info=True)
-
-        # TODO de-duplicate this code in some way - it's ugly
-        try:
-            marker = self.node.find("./Marker[@type='credits']")
-            if marker is not None:
-                self.credits_start = float(marker.get('startTimeOffset')) / 1e3
-                self.credits_end = float(marker.get('endTimeOffset')) / 1e3
-                log.info("Credits Detected: {0} - {1}".format(self.credits_start, self.credits_end))
-        except:
-            log.error("Could not detect credits.", exc_info=True)
+    def needs_full_node(self):
+        # Items built from a play queue may not list their markers.
+        return self.parent.is_partial and self.node.find("./Marker") is None
 
-        self.map_streams()
+    def load_markers(self):
+        """
+        Loads the markers, from the full metadata if the item's node does
+        not list them. This may make a request, so it is done before the
+        item is played rather than while the player is checking markers.
+        """
+        if self._markers is None:
+            node = self.node
+            if self.needs_full_node():
+                try:
+                    node = self.parent.get_full_node()
+                except Exception:
+                    log.warning("Video::load_markers could not load markers", exc_info=True)
+                    node = None
+            self._markers = MarkerIndex(node)
+        return self._markers
+
+    @property
+    def markers(self):
+        # Never makes a request: an item whose markers were not loaded
+        # ahead of time has none until load_markers runs.
+        if self._markers is None:
+            if self.needs_full_node():
+                return MarkerIndex()
+            self._markers = MarkerIndex(self.node)
+        return self._markers
+
+    @property
+    def intro_start(self):
+        return self.markers.first("intro")[0]
+
+    @property
+    def intro_end(self):
+        return self.markers.first("intro")[1]
+
+    @property
+    def credits_start(self):
+        return self.markers.first("credits")[0]
+
+    @property
+    def credits_end(self):
+        return self.markers.first("credits")[1]
 
     def map_streams(self):
-        if not self._part_node:
-            return
-
-        for index, stream in enumerate(self._part_node.findall("./Stream[@streamType='2']") or []):
-            self.audio_uid[index+1] = stream.attrib["id"]
-            self.audio_seq[stream.attrib["id"]] = index+1
-
-        for index, sub in enumerate(self._part_node.findall("./Stream[@streamType='3']") or []):
-            if sub.attrib.get("key") is None:
-                self.subtitle_uid[index+1] = sub.attrib["id"]
-                self.subtitle_seq[sub.attrib["id"]] = index+1
+        self.streams      = StreamTable(self._part_node)
+        self.audio_seq    = self.streams.audio_seq
+        self.audio_uid    = self.streams.audio_uid
+        self.subtitle_seq = self.streams.subtitle_seq
+        self.subtitle_uid = self.streams.subtitle_uid
 
     def get_transcode_streams(self):
         if not self.trs_aid:
-            audio_obj = self._part_node.find("./Stream[@streamType='2'][@selected='1']")
-            self.trs_aid = audio_obj.get("id") if audio_obj is not None else None
+            self.trs_aid = self.streams.get_selected_audio_id()
         if not self.trs_sid:
-            subtitle_obj = self._part_node.find("./Stream[@streamType='3'][@selected='1']")
-            self.trs_sid = subtitle_obj.get("id") if subtitle_obj is not None else None
+            self.trs_sid = self.streams.get_selected_subtitle_id()
         return self.trs_aid, self.trs_sid
 
+    def is_sidecar_sub(self, sub_id):
+        """
+        Returns True if subtitle ``sub_id`` is loaded by mpv next to a
+        transcode instead of being burned into it.
+        """
+        if not settings.sidecar_subtitles or not self.streams.is_external(sub_id):
+            return False
+        return self.streams.by_id[sub_id].get("codec") in TEXT_SUBTITLE_CODECS
+
+    def can_switch_sub(self, sub_id):
+        """
+        Returns True if the current transcode can change to subtitle
+        ``sub_id`` without being restarted.
+        """
+        if self.burn_subs:
+            return False
+        return sub_id == "0" or self.is_sidecar_sub(sub_id)
+
     def select_best_media(self, part=0):
         """
         Nodes are accessed via XPath, which is technically 1-indexed, while
@@ -181,6 +373,7 @@ class Video(MediaItem):
         if node:
             self._part      = part
             self._part_node = node
+            self.map_streams()
             return True
 
         log.error("Video::select_media error selecting part %s" % part)
@@ -205,7 +398,8 @@ class Video(MediaItem):
         if self._part_node != None:
             partid = self._part_node.get("id")
             url = "/library/parts/{0}".format(partid)
-            requests.put(get_plex_url(urllib.parse.urljoin(self.parent.server_url, url), args), data=None)
+            plex_request("PUT", urllib.parse.urljoin(self.parent.server_url, url), args)
+            metadataCache.invalidate(self.parent.server_url)
 
     def get_proper_title(self):
         if not hasattr(self, "_title"):
@@ -269,13 +463,45 @@ class Video(MediaItem):
 
         return audio_formats, protocols
 
-    def get_decision(self, url, args):
-        context = ssl.create_default_context(cafile=certifi.where())
-        tree = et.parse(urllib.request.urlopen(get_plex_url(urllib.parse.urljoin(self.parent.server_url, url), args), context=context))
-        treeRoot = tree.getroot()
+    def get_decision_key(self, args):
+        """
+        Returns what the decision depends on: the item, the selected streams
+        and every request argument except the session, which changes on
+        each restart. The arguments include the media and part index, the
+        bitrate, the subtitle mode and the client profile extras.
+        """
+        request = tuple(sorted((key, str(value)) for key, value in args.items() if key != "session"))
+        return (self.parent.server_url, self.get_rating_key(), self.trs_aid, self.trs_sid,
+                settings.client_profile, request)
+
+    def get_decision(self, url, args, cached=True):
+        """
+        Requests the transcode decision for ``args``. Unless ``cached`` is
+        False, a recent decision for the same request is reused if it
+        allowed direct play. Decisions that lead to a transcode are always
+        requested, since the server needs one for the new session before
+        the transcode starts.
+        """
+        key = self.get_decision_key(args)
+        now = time.monotonic()
+        cached = cached and args.get("directPlay") == "1"
+        if cached:
+            with decision_cache_lock:
+                entry = decision_cache.get(key)
+            if entry is not None and entry[1] > now:
+                log.debug("Decision (cached): {0}".format(entry[0]))
+                return entry[0]
+
+        treeRoot = get_plex_xml(urllib.parse.urljoin(self.parent.server_url, url), args).getroot()
         decisionText = treeRoot.get("generalDecisionText") or treeRoot.get("mdeDecisionText")
         decision = treeRoot.get("generalDecisionCode") or treeRoot.get("mdeDecisionCode")
         log.debug("Decision: {0}: {1}".format(decision, decisionText))
+
+        with decision_cache_lock:
+            for expired in [k for k, v in decision_cache.items() if v[1] <= now]:
+                decision_cache.pop(expired, None)
+            if cached and decision == "1000":
+                decision_cache[key] = (decision, now + DECISION_CACHE_TTL)
         return decision
 
     def is_transcode_suggested(self, video_bitrate=None, force_transcode=False, force_bitrate=False):
@@ -336,7 +562,7 @@ class Video(MediaItem):
                 if request_subtitle_mode == "none":
                     args["directPlay"] = "0"
                     args["subtitles"] = "burn"
-                    decision = self.get_decision(url, args)
+                    decision = self.get_decision(url, args, cached=False)
                     if decision != "1001":
                         log.error("Server reports that file cannot be streamed.")
                 return True
@@ -344,22 +570,92 @@ class Video(MediaItem):
                 log.error("Server reports that file cannot be streamed.")
         return False
 
+    def stop_transcode(self, session):
+        url = "/video/:/transcode/universal/stop"
+        args = {
+            "session":            session,
+        }
+        safe_urlopen(urllib.parse.urljoin(self.parent.server_url, url), args)
+
     def terminate_transcode(self):
-        if get_transcode_session(self.parent.path.hostname, False):
+        session = get_transcode_session(self.parent.path.hostname, False)
+        if session:
             if self.is_transcode:
-                url = "/video/:/transcode/universal/stop"
-                args = {
-                    "session":            get_transcode_session(self.parent.path.hostname),
-                }
-                safe_urlopen(urllib.parse.urljoin(self.parent.server_url, url), args)
+                self.stop_transcode(session)
             clear_transcode_session(self.parent.path.hostname)
 
+    def get_handoff_url(self, offset=0):
+        """
+        Returns the URL to switch to when playback restarts at ``offset``
+        seconds with new settings, and the transcode session to stop once
+        mpv has switched (or ``None``). The current transcode keeps running
+        while the new one is started under a new session and primed.
+        """
+        hostname = self.parent.path.hostname
+        was_transcode = self.is_transcode
+        previous_session = get_transcode_session(hostname, False)
+
+        # Detach the running session so the new request gets its own id
+        # instead of stopping it. It is put back if there is no new URL.
+        clear_transcode_session(hostname)
+        url = None
+        try:
+            url = self.get_playback_url()
+        finally:
+            if not url:
+                self.is_transcode = was_transcode
+                clear_transcode_session(hostname)
+                if previous_session:
+                    set_transcode_session(hostname, previous_session)
+
+        if not url:
+            return None, None
+        if self.is_transcode:
+            prime_transcode(url, offset)
+        return url, previous_session if was_transcode else None
+
+    def prefetch(self):
+        """
+        Loads the markers and requests the transcode decision ahead of time.
+        If the server allows direct play, the playback URL is kept for
+        ``get_playback_url``. Transcode URLs are not kept, since they start a
+        server session.
+        """
+        self.load_markers()
+        if self.trs_ovr or settings.always_transcode:
+            return
+
+        if not self.is_transcode_suggested(settings.transcode_kbps) and self._part_node:
+            url = urllib.parse.urljoin(self.parent.server_url, self._part_node.get("key", ""))
+            self.prefetch_url = get_plex_url(url)
+            self.prefetch_key = self.get_prefetch_key()
+
+    def get_prefetch_key(self):
+        # The settings the prefetched decision depends on.
+        return (settings.always_transcode, settings.auto_transcode, settings.direct_limit,
+                settings.transcode_kbps)
+
+    def get_prefetch_url(self):
+        """
+        Returns the prefetched direct play URL, or ``None`` if there is none
+        or the transcode settings changed since it was decided.
+        """
+        if self.prefetch_url and (self.trs_ovr or self.prefetch_key != self.get_prefetch_key()):
+            log.debug("Video::get_prefetch_url settings changed, dropping prefetched URL")
+            self.prefetch_url = None
+        return self.prefetch_url
+
     def get_playback_url(self, direct_play=None, offset=0, video_bitrate=None, force_transcode=False, force_bitrate=False):
         """
         Returns the URL to use for the trancoded file.
         """
         self.terminate_transcode()
 
+        if self.get_prefetch_url() and direct_play is None:
+            url, self.prefetch_url = self.prefetch_url, None
+            self.is_transcode = False
+            return url
+
         if self.trs_ovr:
             video_bitrate, force_transcode, force_bitrate = self.trs_ovr
         elif video_bitrate is None:
@@ -379,6 +675,10 @@ class Video(MediaItem):
         self.is_transcode = True
         is_local = is_local_domain(self.parent.path.hostname)
 
+        _, sub_id = self.get_transcode_streams()
+        self.burn_subs = not (settings.sidecar_subtitles and
+                              (sub_id in (None, "0") or self.is_sidecar_sub(sub_id)))
+
         url = "/video/:/transcode/universal/start.m3u8"
         args = {
             "path":               self.node.get("key"),
@@ -393,7 +693,7 @@ class Video(MediaItem):
             "offset":             offset,
             "autoAdjustQuality":  str(int(settings.adaptive_transcode)),
             "directStreamAudio":  "1",
-            "subtitles":          "burn",
+            "subtitles":          "burn" if self.burn_subs else "none",
             "copyts":             "1",
             "subtitleSize":       settings.subtitle_size,
             #"skipSubtitles":    "1",
@@ -414,41 +714,15 @@ class Video(MediaItem):
         """
         Returns the index of the selected stream
         """
-        if not self._part_node:
-            return
-
-        match = False
-        index = None
-        for index, stream in enumerate(self._part_node.findall("./Stream[@streamType='2']") or []):
-            if stream.get('selected') == "1":
-                match = True
-                break
-
-        if match:
-            return index+1
-
+        return self.audio_seq.get(self.streams.get_selected_audio_id())
 
     def get_subtitle_idx(self):
-        if not self._part_node:
-            return
-
-        match = False
-        index = None
-        for index, sub in enumerate(self._part_node.findall("./Stream[@streamType='3']") or []):
-            if sub.get('selected') == "1" and sub.get('key') is None:
-                match = True
-                break
-        
-        if match:
-            return index+1
+        return self.subtitle_seq.get(self.streams.get_selected_subtitle_id())
 
     def get_external_sub_id(self):
-        if not self._part_node:
-            return
-
-        for sub in self._part_node.findall("./Stream[@streamType='3']") or []:
-            if sub.get('selected') == "1" and sub.get('key') is not None:
-                return sub.get("id")
+        sub_id = self.streams.get_selected_subtitle_id()
+        if self.streams.is_external(sub_id):
+            return sub_id
 
     def get_external_sub(self, id):
         url = "/library/streams/{0}".format(id)
@@ -486,6 +760,7 @@ class Track(MediaItem):
         self.trs_aid       = None
         self.trs_sid       = None
         self.trs_ovr       = None
+        self.streams       = StreamTable()
         self.audio_seq     = {}
         self.audio_uid     = {}
 
@@ -495,15 +770,10 @@ class Track(MediaItem):
         if not self._media_node:
             self.select_best_media(part)
 
-        self.map_streams()
-
     def map_streams(self):
-        if not self._part_node:
-            return
-
-        for index, stream in enumerate(self._part_node.findall("./Stream[@streamType='2']") or []):
-            self.audio_uid[index+1] = stream.attrib["id"]
-            self.audio_seq[stream.attrib["id"]] = index+1
+        self.streams   = StreamTable(self._part_node)
+        self.audio_seq = self.streams.audio_seq
+        self.audio_uid = self.streams.audio_uid
 
     def select_best_media(self, part=0):
         # Audio is much easier :)
@@ -526,9 +796,10 @@ class Track(MediaItem):
             return False
 
         node = self._media_node.find('./Part[%s]' % (part+1))
-        if node:
+        if node is not None:
             self._part      = part
             self._part_node = node
+            self.map_streams()
             return True
 
         log.error("Track::select_media error selecting part %s" % part)
@@ -541,15 +812,245 @@ class Track(MediaItem):
     def is_multipart(self):
         return False
 
-class XMLCollection(object):
+def parse_xml(response):
+    return et.ElementTree(et.fromstring(response.content))
+
+class EpisodeRecord(object):
+    """
+    The attributes of a series episode needed to queue it. Series lists
+    are kept as these records instead of the full ``<Video>`` elements.
+    """
+    __slots__ = ("key", "parentIndex", "index", "playQueueItemID")
+
+    def __init__(self, node):
+        for attr in self.__slots__:
+            setattr(self, attr, node.get(attr))
+
+    def get(self, attr, default=None):
+        value = getattr(self, attr, None)
+        return default if value is None else value
+
+def parse_episode_records(response):
+    """
+    Streams a series list from ``response`` and returns an ``EpisodeRecord``
+    for each ``<Video>``. Elements are cleared once read, so the full
+    document is never held in memory.
+    """
+    response.raw.decode_content = True
+    records = []
+    root = None
+    for event, node in et.iterparse(response.raw, events=("start", "end")):
+        if event == "start":
+            if root is None:
+                root = node
+        elif node.tag == "Video":
+            records.append(EpisodeRecord(node))
+            root.clear()
+    return records
+
+def has_media_data(node):
+    """
+    Returns True if ``node`` lists everything needed to play it without
+    fetching its metadata. Videos also need their streams to pick tracks.
+    """
+    parts = node.findall("./Media/Part")
+    if not parts:
+        return False
+    if node.tag == "Video":
+        return all(part.find("./Stream") is not None for part in parts)
+    return True
+
+def parse_play_queue(response, version=None):
+    """
+    Streams a play queue from ``response`` and returns the root element and
+    the list of queue items. If the queue has ``version``, the items are
+    not parsed and ``None`` is returned in their place.
+    """
+    response.raw.decode_content = True
+    parser = et.iterparse(response.raw, events=("start",))
+    event, root = next(parser)
+    if version is not None and root.get("playQueueVersion") == version:
+        return root, None
+
+    for event, node in parser:
+        pass
+    return root, [node for node in root if node.tag in ("Video", "Track")]
+
+class PlayQueue(object):
+    """
+    The part of a Plex play queue around the item being played. Only
+    ``PLAY_QUEUE_WINDOW`` items on either side of that item are fetched, and
+    the window is moved when playback gets close to its edge. The queue is
+    shared by all ``Media`` objects created from it.
+    """
     def __init__(self, url):
+        self.url            = url
+        self.attrib         = {}
+        self.items          = []
+        self.ids            = {}
+        self.more_before    = False
+        self.more_after     = False
+        self.lock           = Lock()
+
+    def get_url(self, center=None, window=PLAY_QUEUE_WINDOW):
+        parsed_url = urllib.parse.urlparse(self.url)
+        query = urllib.parse.parse_qs(parsed_url.query)
+        query["window"] = [window]
+        query["includeBefore"] = [1]
+        query["includeAfter"] = [1]
+        if center:
+            query["center"] = [center]
+        else:
+            query.pop("center", None)
+        return urllib.parse.urlunparse(parsed_url._replace(query=urllib.parse.urlencode(query, doseq=True)))
+
+    def is_loaded(self, item_id):
+        """
+        Returns True if ``item_id`` is in the window and not so close to
+        its edge that the neighbouring items may be missing.
+        """
+        idx = self.ids.get(item_id)
+        if idx is None:
+            return False
+        if self.more_before and idx < PLAY_QUEUE_MARGIN:
+            return False
+        if self.more_after and len(self.items) - idx <= PLAY_QUEUE_MARGIN:
+            return False
+        return True
+
+    def sync(self, center=None, full=False):
         """
-        ``url`` should be a URL to the Plex XML media item.
+        Fetches the window around the item with the playQueueItemID
+        ``center``, or around the selected item, or the whole queue if
+        ``full`` is set. If the window would not move and the server still
+        has the loaded version of the queue, the items are not parsed again.
+        Returns True if the items changed.
+        """
+        with self.lock:
+            window = PLAY_QUEUE_WINDOW
+            version = None
+            if full:
+                window = max(window, int(self.attrib.get("playQueueTotalCount", 0)))
+            elif self.is_loaded(center):
+                version = self.attrib.get("playQueueVersion")
+
+            # Unread responses are closed rather than returned to the pool,
+            # which is cheaper than downloading a queue we already have.
+            with plex_request("GET", self.get_url(center, window), stream=True) as response:
+                response.raise_for_status()
+                root, items = parse_play_queue(response, version)
+
+            if items is None:
+                log.debug("PlayQueue::sync version %s is unchanged" % version)
+                return False
+
+            ids = {item.get("playQueueItemID"): i for i, item in enumerate(items)}
+            total = int(root.get("playQueueTotalCount") or len(items))
+            selected = ids.get(root.get("playQueueSelectedItemID"))
+            offset = root.get("playQueueSelectedItemOffset")
+            if selected is not None and offset is not None:
+                first = int(offset) - selected
+                self.more_before = first > 0
+                self.more_after = first + len(items) < total
+            elif ids.get(center) is not None:
+                # The window was cut short on the sides where the queue ends.
+                self.more_before = ids[center] >= window
+                self.more_after = len(items) - ids[center] > window
+            else:
+                self.more_before = self.more_after = len(items) < total
+
+            self.attrib = dict(root.attrib)
+            self.items = items
+            self.ids = ids
+            log.debug("PlayQueue::sync loaded %d of %d items (version %s)" % (len(items), total,
+                      self.attrib.get("playQueueVersion")))
+            return True
+
+    def find(self, key, item_id=None):
+        """
+        Returns the queue item with ``item_id``, or else the item with
+        ``key``, preferring the selected item.
+        """
+        items, ids = self.items, self.ids
+        if item_id in ids:
+            return items[ids[item_id]]
+
+        selected = ids.get(self.attrib.get("playQueueSelectedItemID"))
+        if selected is not None and items[selected].get("key") == key:
+            return items[selected]
+
+        for item in items:
+            if item.get("key") == key:
+                return item
+
+    def get_item(self, item_id, step=0):
+        items, ids = self.items, self.ids
+        idx = ids.get(item_id)
+        if idx is not None and 0 <= idx + step < len(items):
+            return items[idx + step]
+
+    def index(self, item_id):
+        return self.ids.get(item_id)
+
+    def has_next(self, item_id):
+        idx = self.ids.get(item_id)
+        return idx is not None and (idx < len(self.items) - 1 or self.more_after)
+
+    def has_prev(self, item_id):
+        idx = self.ids.get(item_id)
+        return idx is not None and (idx > 0 or self.more_before)
+
+def get_plex_xml(url, data=None):
+    """
+    Fetches ``url`` from the Plex server and returns the parsed ElementTree.
+    """
+    response = plex_request("GET", url, data)
+    response.raise_for_status()
+    return parse_xml(response)
+
+def get_hls_playlist(url):
+    response = get_http_session(url).get(url, headers=get_plex_headers(url), timeout=get_http_timeout())
+    response.raise_for_status()
+    return [line.strip() for line in response.text.splitlines() if line.strip()]
+
+def prime_transcode(url, offset=0):
+    """
+    Loads the playlists of an HLS transcode and the segment at ``offset``
+    seconds, so the server is already transcoding there when mpv opens
+    the stream. Returns True if the segment was loaded.
+    """
+    try:
+        variant = next((line for line in get_hls_playlist(url) if not line.startswith("#")), None)
+        if variant is None:
+            return False
+
+        variant_url = urllib.parse.urljoin(url, variant)
+        position, duration = 0, None
+        for line in get_hls_playlist(variant_url):
+            if line.startswith("#EXTINF:"):
+                duration = float(line[len("#EXTINF:"):].split(",")[0])
+            elif not line.startswith("#") and duration is not None:
+                if position + duration > offset:
+                    segment_url = urllib.parse.urljoin(variant_url, line)
+                    response = get_http_session(segment_url).get(segment_url, headers=get_plex_headers(segment_url),
+                                                                 timeout=get_http_timeout())
+                    response.raise_for_status()
+                    return True
+                position += duration
+        return False
+    except Exception:
+        log.warning("prime_transcode could not prepare %s" % sanitize_msg(url), exc_info=True)
+        return False
+
+class XMLCollection(object):
+    def __init__(self, url, tree=None):
+        """
+        ``url`` should be a URL to the Plex XML media item. If ``tree`` is
+        given, it is used instead of fetching ``url``.
         """
         self.path       = urllib.parse.urlparse(url)
         self.server_url = self.path.scheme + "://" + self.path.netloc
-        self.context   = ssl.create_default_context(cafile=certifi.where())
-        self.tree       = et.parse(urllib.request.urlopen(get_plex_url(url), context=self.context))
+        self.tree       = tree if tree is not None else metadataCache.fetch(url, parse_xml)
 
     def get_path(self, path):
         parsed_url = urllib.parse.urlparse(path)
@@ -564,17 +1065,30 @@ class XMLCollection(object):
         return self.path.path
 
 class Media(XMLCollection):
-    def __init__(self, url, series=None, seq=None, play_queue=None, play_queue_xml=None, media_type=MediaType.VIDEO):
-        # Include Markers
+    def __init__(self, url, series=None, seq=None, play_queue=None, queue=None, media_type=MediaType.VIDEO,
+                 queue_item_id=None, node=None):
+        # Include Markers and Chapters
         if "?" in url:
             sep = "&"
         else:
             sep = "?"
-        url = url + sep + "includeMarkers=1"
-        
-        XMLCollection.__init__(self, url)
+        url = url + sep + "includeMarkers=1&includeChapters=1"
 
+        # Queue items that list their media are used as they are.
+        tree = None
+        if node is not None and queue is not None:
+            container = et.Element("MediaContainer", queue.attrib)
+            container.append(node)
+            tree = et.ElementTree(container)
+
+        XMLCollection.__init__(self, url, tree)
+
+        self.is_partial = tree is not None
         self.media_type = media_type
+        serverRegistry.warm(self.server_url)
+        self.next_lock = Lock()
+        self.next_media = None
+        self.prepared_item = None
 
         if self.media_type == MediaType.VIDEO:
             self.media_item = self.tree.find('./Video')
@@ -586,16 +1100,15 @@ class Media(XMLCollection):
         self.has_next = False
         self.has_prev = False
         self.play_queue = play_queue
-        self.play_queue_xml = play_queue_xml
+        self.queue = queue
+        self.queue_item_id = queue_item_id
 
         if self.play_queue:
-            if not series:
+            if self.queue is None:
+                self.queue = PlayQueue(self.get_path(self.play_queue))
                 self.upd_play_queue()
             else:
-                self.series = series
-                self.seq = seq
-                self.has_next = self.seq < len(self.series) - 1
-                self.has_prev = self.seq > 0
+                self.upd_queue_position()
         elif self.is_tv:
             if series:
                 self.series = series
@@ -603,9 +1116,9 @@ class Media(XMLCollection):
             else:
                 self.series = []
                 specials = []
-                series_xml = XMLCollection(self.get_path(self.media_item.get("grandparentKey")+"/allLeaves"))
-                videos = series_xml.tree.findall('./Video')
-                
+                series_url = self.get_path(self.media_item.get("grandparentKey")+"/allLeaves")
+                videos = metadataCache.fetch(series_url, parse_episode_records, stream=True)
+
                 # This part is kind of nasty, so we only try to do it once per cast session.
                 key = self.media_item.get('key')
                 is_special = False
@@ -627,66 +1140,108 @@ class Media(XMLCollection):
 
     def upd_play_queue(self):
         if self.play_queue:
-            if self.media_type == MediaType.VIDEO:
-                self.play_queue_xml = XMLCollection(self.get_path(self.play_queue))
-                videos = self.play_queue_xml.tree.findall('./Video')
-                self.series = []
-
-                key = self.media_item.get('key')
-                for i, video in enumerate(videos):
-                    if video.get('key') == key:
-                        self.seq = i
-                    self.series.append(video)
-
-                self.has_next = self.seq < len(self.series) - 1
-                self.has_prev = self.seq > 0
-            elif self.media_type == MediaType.MUSIC:
-                self.play_queue_xml = XMLCollection(self.get_path(self.play_queue))
-                tracks = self.play_queue_xml.tree.findall('./Track')
-                self.series = []
-
-                key = self.media_item.get('key')
-                for i, track in enumerate(tracks):
-                    if track.get('key') == key:
-                        self.seq = i
-                    self.series.append(track)
-
-                self.has_next = self.seq < len(self.series) - 1
-                self.has_prev = self.seq > 0
+            if self.queue.sync(self.queue_item_id):
+                self.next_media = None
+            if self.queue.index(self.queue_item_id) is None:
+                item = self.queue.find(self.media_item.get("key"))
+                if item is not None:
+                    self.queue_item_id = item.get("playQueueItemID")
+            self.upd_queue_position()
+
+    def upd_queue_position(self):
+        self.seq = self.queue.index(self.queue_item_id)
+        self.has_next = self.queue.has_next(self.queue_item_id)
+        self.has_prev = self.queue.has_prev(self.queue_item_id)
 
     def get_queue_info(self):
         return {
             "containerKey": self.play_queue,
-            "playQueueID": self.play_queue_xml.tree.find(".").get("playQueueID"),
-            "playQueueVersion": self.play_queue_xml.tree.find(".").get("playQueueVersion"),
-            "playQueueItemID": self.series[self.seq].get("playQueueItemID")
+            "playQueueID": self.queue.attrib.get("playQueueID"),
+            "playQueueVersion": self.queue.attrib.get("playQueueVersion"),
+            "playQueueItemID": self.queue_item_id
         }
 
+    def get_queue_media(self, item):
+        if item is not None:
+            return Media(self.get_path(item.get('key')), play_queue=self.play_queue, queue=self.queue,
+                         media_type=self.media_type, queue_item_id=item.get("playQueueItemID"),
+                         node=item if has_media_data(item) else None)
+
+    def get_full_node(self):
+        """
+        Returns the item's node from its full metadata document.
+        """
+        tree = metadataCache.fetch(self.path.geturl(), parse_xml)
+        if self.media_type == MediaType.VIDEO:
+            return tree.find("./Video")
+        return tree.find("./Track")
+
     def get_next(self):
+        # Waits for a running prefetch instead of loading the item twice.
+        with self.next_lock:
+            next_media, self.next_media = self.next_media, None
+            if next_media is None:
+                next_media = self.load_next()
+            return next_media
+
+    def prefetch_next(self):
+        """
+        Loads the next item, its server identity and its playback decision
+        so that ``get_next`` can return it without any server round trips.
+        This is meant to run on a background thread during playback.
+        """
+        with self.next_lock:
+            if self.next_media is not None or not self.has_next:
+                return
+
+            next_media = self.load_next()
+            if next_media is None:
+                return
+
+            next_media.get_machine_identifier()
+            next_media.prepared_item = next_media.get_media_item(0)
+            if next_media.prepared_item:
+                next_media.prepared_item.prefetch()
+            self.next_media = next_media
+
+    def load_next(self):
         if self.has_next:
-            if self.play_queue and self.seq+2 == len(self.series):
-                self.upd_play_queue()
+            if self.play_queue:
+                if not self.queue.is_loaded(self.queue_item_id):
+                    self.upd_play_queue()
+                return self.get_queue_media(self.queue.get_item(self.queue_item_id, 1))
             next_video = self.series[self.seq+1]
-            return Media(self.get_path(next_video.get('key')), self.series, self.seq+1, self.play_queue, self.play_queue_xml, self.media_type)
+            return Media(self.get_path(next_video.get('key')), self.series, self.seq+1, media_type=self.media_type)
     
     def get_prev(self):
         if self.has_prev:
-            if self.play_queue and self.seq-1 == 0:
-                self.upd_play_queue()
+            if self.play_queue:
+                if not self.queue.is_loaded(self.queue_item_id):
+                    self.upd_play_queue()
+                return self.get_queue_media(self.queue.get_item(self.queue_item_id, -1))
             prev_video = self.series[self.seq-1]
-            return Media(self.get_path(prev_video.get('key')), self.series, self.seq-1, self.play_queue, self.play_queue_xml, self.media_type)
+            return Media(self.get_path(prev_video.get('key')), self.series, self.seq-1, media_type=self.media_type)
 
-    def get_from_key(self, key):
+    def get_from_key(self, key, item_id=None):
         if self.play_queue:
             self.upd_play_queue()
-            for i, video in enumerate(self.series):
-                if video.get("key") == key:
-                    return Media(self.get_path(key), self.series, i, self.play_queue, self.play_queue_xml, self.media_type)
-            return None
+            item = self.queue.find(key, item_id)
+            if item is None:
+                # The item is outside of the window.
+                if item_id:
+                    self.queue.sync(item_id)
+                else:
+                    self.queue.sync(full=True)
+                item = self.queue.find(key, item_id)
+            return self.get_queue_media(item)
         else:
             return Media(self.get_path(key), media_type=self.media_type)
 
     def get_media_item(self, index, media=0, part=0):
+        if index == 0 and not media and not part and self.prepared_item:
+            media_item, self.prepared_item = self.prepared_item, None
+            return media_item
+
         if self.media_type == MediaType.VIDEO:
             if index == 0 and self.media_item:
                 return Video(self.media_item, self, media, part)
@@ -705,11 +1260,6 @@ class Media(XMLCollection):
 
         log.error("Media::get_media_item couldn't find {} at index {}".format(self.media_type, index))
 
-    def get_machine_identifier(self):
-        if not hasattr(self, "_machine_identifier"):
-            context = ssl.create_default_context(cafile=certifi.where())
-            doc = urllib.request.urlopen(get_plex_url(self.server_url), context=context)
-            tree = et.parse(doc)
-            setattr(self, "_machine_identifier", tree.find('.').get("machineIdentifier"))
-        return getattr(self, "_machine_identifier", None)
+    def get_machine_identifier(self, block=True):
+        return serverRegistry.get_server(self.server_url, block).machine_identifier
 
@@ -109,19 +109,20 @@ class OSDMenu(object):
     def show_menu(self):
         self.is_menu_shown = True
         player = self.playerManager._player
-        player.osd_back_color = '#CC333333'
-        player.osd_font_size = 40
+        with self.playerManager.batch() as batch:
+            batch.set("osd_back_color", '#CC333333')
+            batch.set("osd_font_size", 40)
 
-        if hasattr(player, 'osc'):
-            player.osc = False
-        
-        player.command("script-message", "shim-menu-enable", "True")
+            if hasattr(player, 'osc'):
+                batch.set("osc", False)
+
+            batch.command("script-message", "shim-menu-enable", "True")
 
         self.menu_title = "Main Menu"
         self.menu_selection = 0
         self.mouse_back = False
 
-        if self.playerManager._media_item and not player.playback_abort:
+        if self.playerManager._media_item and not self.playerManager.is_stopped():
             self.menu_list = [
                 ("Change Audio", self.change_audio_menu),
                 ("Change Subtitles", self.change_subtitle_menu),
@@ -150,33 +151,35 @@ class OSDMenu(object):
         # Wait until the menu renders to pause.
         time.sleep(0.2)
 
-        if player.playback_abort:
-            player.force_window = True
-            player.keep_open = True
-            player.play("")
-            if settings.fullscreen:
-                player.fs = True
-        else:
-            player.pause = True
+        with self.playerManager.batch() as batch:
+            if self.playerManager.is_stopped():
+                batch.set("force_window", True)
+                batch.set("keep_open", True)
+                batch.command("loadfile", "")
+                if settings.fullscreen:
+                    batch.set("fs", True)
+            else:
+                batch.set("pause", True)
 
     def hide_menu(self):
         player = self.playerManager._player
         if self.is_menu_shown:
-            player.osd_back_color = self.original_osd_color
-            player.osd_font_size = self.original_osd_size
-            player.show_text("",0,0)
-            player.force_window = False
-            player.keep_open = False
+            with self.playerManager.batch() as batch:
+                batch.set("osd_back_color", self.original_osd_color)
+                batch.set("osd_font_size", self.original_osd_size)
+                batch.command("show-text", "", 0, 0)
+                batch.set("force_window", False)
+                batch.set("keep_open", False)
 
-            if hasattr(player, 'osc'):
-                player.osc = settings.enable_osc
+                if hasattr(player, 'osc'):
+                    batch.set("osc", settings.enable_osc)
 
-            player.command("script-message", "shim-menu-enable", "False")
+                batch.command("script-message", "shim-menu-enable", "False")
 
-            if player.playback_abort:
-                player.play("")
-            else:
-                player.pause = False
+                if self.playerManager.is_stopped():
+                    batch.command("loadfile", "")
+                else:
+                    batch.set("pause", False)
 
         self.is_menu_shown = False
 
@@ -224,8 +227,7 @@ class OSDMenu(object):
         self.put_menu("Select Audio Track")
 
         selected_aid, _ = self.playerManager.get_track_ids()
-        audio_streams = self.playerManager._media_item._part_node.findall("./Stream[@streamType='2']")
-        for i, audio_track in enumerate(audio_streams):
+        for i, audio_track in enumerate(self.playerManager._media_item.streams.audio):
             aid = audio_track.get("id")
             self.menu_list.append([
                 "{0} ({1})".format(audio_track.get("displayTitle"), audio_track.get("title")),
@@ -247,9 +249,8 @@ class OSDMenu(object):
         self.put_menu("Select Subtitle Track")
 
         _, selected_sid = self.playerManager.get_track_ids()
-        subtitle_streams = self.playerManager._media_item._part_node.findall("./Stream[@streamType='3']")
         self.menu_list.append(["None", self.change_subtitle_menu_handle, "0"])
-        for i, subtitle_track in enumerate(subtitle_streams):
+        for i, subtitle_track in enumerate(self.playerManager._media_item.streams.subtitles):
             sid = subtitle_track.get("id")
             self.menu_list.append([
                 "{0} ({1})".format(subtitle_track.get("displayTitle"), subtitle_track.get("title")),
@@ -370,7 +371,8 @@ class OSDMenu(object):
             self.menu_action("back")
         self.preferences_menu()
 
-        if self.playerManager._media_item.is_transcode:
+        media_item = self.playerManager._media_item
+        if media_item.is_transcode and media_item.burn_subs:
             if setting_name == "subtitle_size":
                 self.playerManager.put_task(self.playerManager.update_subtitle_visuals)
         else:
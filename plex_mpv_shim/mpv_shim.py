@@ -48,6 +48,8 @@ def main():
     from .timeline import timelineManager
     from .action_thread import actionThread
     from .client import HttpServer
+    from .subscribers import subscriberReaper
+    from .play_pipeline import playPipeline
 
     update_gdm_settings()
     gdm.start_all()
@@ -58,6 +60,8 @@ def main():
     server.start()
 
     timelineManager.start()
+    subscriberReaper.start()
+    playPipeline.start()
     playerManager.timeline_trigger = timelineManager.trigger
     actionThread.start()
     playerManager.action_trigger = actionThread.trigger
@@ -72,6 +76,8 @@ def main():
         playerManager.terminate()
         server.stop()
         timelineManager.stop()
+        subscriberReaper.stop()
+        playPipeline.stop()
         actionThread.stop()
         gdm.stop_all()
 
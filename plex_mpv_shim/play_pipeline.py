@@ -0,0 +1,105 @@
+"""
+play_pipeline.py - Play Request Pipeline
+
+Runs playMedia requests on a thread of their own so the remote is
+answered right away. Only the latest request is played: a newer request
+(or a stop) cancels an older one at the next stage it reaches, so an
+abandoned request never gets to mpv.
+"""
+import logging
+import os
+import threading
+from threading import Event, Lock
+
+from .conf import settings
+from .media import Media
+from .player import playerManager
+from .timeline import timelineManager
+
+log = logging.getLogger('play_pipeline')
+
+class PlayJob(object):
+    def __init__(self, pipeline, generation, func, args):
+        self.pipeline   = pipeline
+        self.generation = generation
+        self.func       = func
+        self.args       = args
+
+    def is_current(self):
+        return self.pipeline.generation == self.generation
+
+    def run(self):
+        self.func(self, *self.args)
+
+class PlayPipeline(threading.Thread):
+    def __init__(self):
+        self.trigger    = Event()
+        self.lock       = Lock()
+        self.halt       = False
+        self.pending    = None
+        self.generation = 0
+
+        threading.Thread.__init__(self, name="Play Pipeline", daemon=True)
+
+    def submit(self, func, *args):
+        """
+        Runs ``func(job, *args)`` on the pipeline thread, cancelling any
+        earlier job. ``func`` should check ``job.is_current()`` between
+        stages and give up once it returns False.
+        """
+        with self.lock:
+            self.generation += 1
+            self.pending = PlayJob(self, self.generation, func, args)
+        self.trigger.set()
+
+    def cancel(self):
+        with self.lock:
+            self.generation += 1
+            self.pending = None
+
+    def stop(self):
+        self.halt = True
+        self.cancel()
+        self.trigger.set()
+        self.join()
+
+    def run(self):
+        while not self.halt:
+            self.trigger.wait()
+            self.trigger.clear()
+            with self.lock:
+                job, self.pending = self.pending, None
+            if job is None:
+                continue
+
+            try:
+                job.run()
+            except Exception:
+                log.error("PlayPipeline::run error playing media", exc_info=True)
+
+def play_media(job, url, media_type, play_queue, offset):
+    if play_queue:
+        media = Media(url, media_type=media_type, play_queue=play_queue)
+    else:
+        media = Media(url, media_type=media_type)
+
+    log.debug("PlayPipeline::play_media %s" % media)
+    if not job.is_current():
+        return
+
+    # TODO: Select video, media and part here based off user settings
+    media_item = media.get_media_item(0)
+    if not media_item or not job.is_current():
+        return
+
+    if settings.pre_media_cmd:
+        os.system(settings.pre_media_cmd)
+    if not job.is_current():
+        return
+
+    if playerManager.play(media_item, offset, job.is_current):
+        timelineManager.SendTimelineToSubscribers()
+    else:
+        log.debug("PlayPipeline::play_media %s was superseded" % media)
+
+playPipeline = PlayPipeline()
@@ -2,14 +2,17 @@ import logging
 import os
 import sys
 import requests
+import threading
+import time
 import urllib.parse
 
 from threading import RLock, Lock
 from queue import Queue
 from collections import OrderedDict
+from contextlib import contextmanager
 
 from . import conffile
-from .utils import synchronous, Timer, get_resource
+from .utils import synchronous, Timer, get_resource, get_plex_headers
 from .conf import settings
 from .menu import OSDMenu
 from .media import MediaType
@@ -40,6 +43,39 @@ SUBTITLE_POS = {
     "middle": 80,
 }
 
+# mpv properties mirrored into PlayerManager.state by property observers,
+# with the values assumed until mpv reports them.
+OBSERVED_PROPERTIES = {
+    "playback-abort":   True,
+    "pause":            False,
+    "volume":           100,
+    "aid":              None,
+    "sid":              None,
+    "playback-time":    None,
+}
+
+# Marker types that can be skipped, with the settings that skip them
+# automatically or prompt for them, and the name shown on the OSD.
+SKIPPABLE_MARKERS = (
+    ("intro",   "skip_intro_always",   "skip_intro_prompt",   "Intro"),
+    ("credits", "skip_credits_always", "skip_credits_prompt", "Credits"),
+)
+SKIPPABLE_MARKER_TYPES = [marker[0] for marker in SKIPPABLE_MARKERS]
+# Marker boundaries closer than this (in seconds) get their own check
+# instead of waiting for the next action thread tick.
+MARKER_CHECK_HORIZON = 1.5
+# Seconds to wait past a boundary so the check sees the new position.
+MARKER_CHECK_SLACK = 0.02
+# Seconds to wait for the replies to a batch of commands.
+BATCH_TIMEOUT = 10
+# Seconds without a new seek request before seeking exactly to the last
+# target. Requests closer together than this are treated as scrubbing.
+SEEK_SETTLE = 0.35
+# Minimum seconds between the keyframe seeks made while scrubbing.
+SEEK_FAST_INTERVAL = 0.1
+# Seconds to wait for a queued item to load when mpv moves on to it.
+HANDOFF_TIMEOUT = 5
+
 mpv_log_levels = {
     "fatal": mpv_log.error,
     "error": mpv_log.error,
@@ -65,6 +101,151 @@ if sys.platform.startswith("win32") or sys.platform.startswith("cygwin"):
 #    put_task is used to deal with the events originating from
 #    the event thread, which would cause deadlock if they run there.
 
+class DiscardedReply(object):
+    """
+    Stands in for the wait event of a batched request that timed out.
+    """
+    def __init__(self, mpv_inter, command_id):
+        self.mpv_inter = mpv_inter
+        self.command_id = command_id
+
+    def set(self):
+        self.mpv_inter.cid_result.pop(self.command_id, None)
+        self.mpv_inter.cid_wait.pop(self.command_id, None)
+
+class CommandBatch(object):
+    """
+    Collects property sets and commands so they can be sent to mpv
+    together. With the external mpv backend, every command is written to
+    the socket before any reply is awaited, so the whole batch costs a
+    single round trip. Use ``PlayerManager.batch`` to create one.
+
+    Commands mpv rejected are listed in ``failures`` as (command, error)
+    pairs once the batch has run.
+    """
+    def __init__(self, player):
+        self.player = player
+        self.commands = []
+        self.failures = []
+
+    def set(self, name, value):
+        self.commands.append(("set_property", name.replace("_", "-"), value))
+
+    def command(self, name, *args):
+        self.commands.append((name,) + args)
+
+    def run(self):
+        commands, self.commands = self.commands, []
+        if not commands:
+            return self.failures
+
+        if is_using_ext_mpv and self.player.mpv_inter is not None:
+            self.run_pipelined(self.player.mpv_inter, commands)
+            return self.failures
+
+        for command in commands:
+            try:
+                if command[0] == "set_property":
+                    setattr(self.player, command[1].replace("-", "_"), command[2])
+                else:
+                    self.player.command(*command)
+            except Exception as ex:
+                log.warning("CommandBatch::run %s failed" % (command,), exc_info=True)
+                self.failures.append((command, str(ex)))
+        return self.failures
+
+    def run_pipelined(self, mpv_inter, commands):
+        # This follows MPVInter.command, but sends every request before
+        # waiting for the first reply.
+        waits = []
+        with mpv_inter.socket_lock:
+            for command in commands:
+                with mpv_inter.rid_lock:
+                    command_id = mpv_inter.command_id
+                    mpv_inter.command_id += 1
+                event = threading.Event()
+                mpv_inter.cid_wait[command_id] = event
+                mpv_inter.socket.send({"command": list(command), "request_id": command_id})
+                waits.append((command, command_id, event))
+
+        deadline = time.monotonic() + BATCH_TIMEOUT
+        for command, command_id, event in waits:
+            if not event.wait(max(deadline - time.monotonic(), 0)):
+                log.warning("CommandBatch::run no response to %s" % (command,))
+                self.discard_reply(mpv_inter, command_id, event)
+                self.failures.append((command, "timeout"))
+                continue
+            data = mpv_inter.cid_result.pop(command_id)
+            del mpv_inter.cid_wait[command_id]
+            if data["error"] != "success":
+                log.warning("CommandBatch::run %s failed: %s" % (command, data["error"]))
+                self.failures.append((command, data["error"]))
+
+    def discard_reply(self, mpv_inter, command_id, event):
+        # MPVInter's reader expects a waiter for every reply, so removing it
+        # now would break the connection if the reply still arrives. It is
+        # replaced by one that removes both entries when the reply comes.
+        mpv_inter.cid_wait[command_id] = DiscardedReply(mpv_inter, command_id)
+        if event.is_set() or command_id in mpv_inter.cid_result:
+            mpv_inter.cid_result.pop(command_id, None)
+            mpv_inter.cid_wait.pop(command_id, None)
+
+class StartPlan(object):
+    """
+    Works out where an item starts and which tracks it starts with before
+    it is loaded, so mpv opens it there instead of seeking and switching
+    tracks once playback has begun.
+    """
+    def __init__(self, media_item, offset=0):
+        self.offset     = offset or 0
+        self.intro      = None
+        self.audio      = None
+        self.sub        = None
+        self.xsub_id    = None
+        self.xsub_url   = None
+
+        if media_item.media_type != MediaType.VIDEO:
+            return
+
+        if settings.skip_intro_always:
+            self.intro = media_item.markers.find("intro", self.offset)
+            if self.intro is not None:
+                self.offset = self.intro[1]
+
+        if media_item.is_transcode:
+            _, sub_id = media_item.get_transcode_streams()
+            if not media_item.burn_subs and media_item.is_sidecar_sub(sub_id):
+                self.set_external_sub(media_item, sub_id)
+            return
+
+        self.audio = media_item.get_audio_idx()
+        self.sub = media_item.get_subtitle_idx()
+        if self.sub is None:
+            sub_id = media_item.get_external_sub_id()
+            if sub_id is not None:
+                self.set_external_sub(media_item, sub_id)
+            else:
+                self.sub = "no"
+
+    def set_external_sub(self, media_item, sub_id):
+        self.sub = "auto"
+        self.xsub_id = sub_id
+        self.xsub_url = media_item.get_external_sub(sub_id)
+
+    def get_options(self):
+        """
+        Returns the mpv options to set before loading the item.
+        """
+        options = {
+            "start":        str(self.offset) if self.offset > 0 else "none",
+            "sub_files":    [self.xsub_url] if self.xsub_url else [],
+        }
+        if self.audio is not None:
+            options["aid"] = self.audio
+        if self.sub is not None:
+            options["sid"] = self.sub
+        return options
+
 class PlayerManager(object):
     """
     Manages the relationship between a ``Player`` instance and a ``Media``
@@ -87,10 +268,20 @@ class PlayerManager(object):
         self.external_subtitles_rev = {}
         self.url = None
         self.evt_queue = Queue()
-        self.is_in_intro = False
-        self.is_in_credits = False
-        self.intro_has_triggered = False
-        self.credits_has_triggered = False
+        self.active_markers = {}
+        self.triggered_markers = set()
+        self.marker_timer = None
+        self.seek_lock = Lock()
+        self.seek_target = None
+        self.seek_timer = None
+        self.seek_generation = 0
+        self.seek_needs_exact = False
+        self.last_fast_seek = 0
+        self.prefetch_started = False
+        self.queued_item = None
+        self.queued_url = None
+        self.http_headers = {}
+        self._batch = threading.local()
 
         if is_using_ext_mpv:
             mpv_options.update(
@@ -116,11 +307,25 @@ class PlayerManager(object):
                                input_media_keys=True, log_handler=mpv_log_handler,
                                loglevel=settings.mpv_log_level, **mpv_options)
         self.menu = OSDMenu(self)
+
+        # The timeline, menu and HTTP handlers read playback state from
+        # here instead of asking mpv, so they never wait on the lock.
+        self.state = dict(OBSERVED_PROPERTIES)
+
+        def handle_state(name, value):
+            self.state[name] = value
+
+        for name in OBSERVED_PROPERTIES:
+            self._player.property_observer(name)(handle_state)
+
         if hasattr(self._player, 'osc'):
             self._player.osc = settings.enable_osc
         else:
             log.warning("This mpv version doesn't support on-screen controller.")
 
+        if settings.gapless_playback:
+            self._player.prefetch_playlist = True
+
         # Wrapper for on_key_press that ignores None.
         def keypress(key):
             def wrapper(func):
@@ -156,11 +361,7 @@ class PlayerManager(object):
         @self._player.on_key_press('XF86_NEXT')
         def handle_media_next():
             if settings.media_key_seek:
-                if self.is_in_intro:
-                    self.skip_intro()
-                elif self.is_in_credits:
-                    self.skip_credits()
-                else:
+                if not self.skip_active_marker():
                     self._player.command("seek", 30)
             else:
                 self.put_task(self.play_next)
@@ -203,11 +404,7 @@ class PlayerManager(object):
             if self.menu.is_menu_shown:
                 self.menu.menu_action('right')
             else:
-                if self.is_in_intro:
-                    self.skip_intro()
-                elif self.is_in_credits:
-                    self.skip_credits()
-                else:
+                if not self.skip_active_marker():
                     self._player.command("seek", settings.seek_right)
 
         @keypress(settings.kb_menu_up)
@@ -215,11 +412,7 @@ class PlayerManager(object):
             if self.menu.is_menu_shown:
                 self.menu.menu_action('up')
             else:
-                if self.is_in_intro:
-                    self.skip_intro()
-                elif self.is_in_credits:
-                    self.skip_credits()
-                else:
+                if not self.skip_active_marker():
                     self._player.command("seek", settings.seek_up)
 
         @keypress(settings.kb_menu_down)
@@ -247,14 +440,20 @@ class PlayerManager(object):
         def handle_end(_name, reached_end):
             if self._media_item and reached_end:
                 has_lock = self._finished_lock.acquire(False)
-                self.put_task(self.finished_callback, has_lock)
+                self.put_task(self.finished_callback, has_lock, self._media_item)
+
+        # Fires when mpv moves on to an item queued for gapless playback.
+        @self._player.property_observer("playlist-pos")
+        def handle_playlist_pos(_name, value):
+            if self.queued_item and value == 1:
+                self.put_task(self.gapless_handoff)
 
         # Fires at the end.
         @self._player.property_observer("playback-abort")
         def handle_end_idle(_name, value):
             if self._media_item and value:
                 has_lock = self._finished_lock.acquire(False)
-                self.put_task(self.finished_callback, has_lock)
+                self.put_task(self.finished_callback, has_lock, self._media_item)
 
         @self._player.event_callback('client-message')
         def handle_client_message(event):
@@ -288,6 +487,11 @@ class PlayerManager(object):
     # of an event handler, which causes a crash.
     def put_task(self, func, *args):
         self.evt_queue.put([func, args])
+        self.trigger_action()
+
+    # Wake up the action thread without waiting
+    # for the next tick.
+    def trigger_action(self):
         if self.action_trigger:
             self.action_trigger.set()
 
@@ -297,77 +501,211 @@ class PlayerManager(object):
         if self.timeline_trigger:
             self.timeline_trigger.set()
 
-    def skip_marker(self, end_point):
-        if self._media_item.media_type == MediaType.VIDEO:
-            self._player.playback_time = end_point
+    def skip_marker(self, marker_type):
+        marker = self.active_markers.pop(marker_type, None)
+        if marker is not None and self._media_item.media_type == MediaType.VIDEO:
+            self._player.playback_time = marker[1]
             self.timeline_handle()
             return True
         return False
 
-    def skip_intro(self):
-        end_point = self._media_item.intro_end
-        if self.skip_marker(end_point):
-            self.is_in_intro = False
-
-    def skip_credits(self):
-        end_point = self._media_item.credits_end
-        if self.skip_marker(end_point):
-            self.is_in_credits = False
-
-    def check_intro_or_credits(self):
-        if ((settings.skip_intro_always or settings.skip_intro_prompt)
-            and self._media_item is not None and self._media_item.media_type == MediaType.VIDEO and self._media_item.intro_start is not None
-            and self._player.playback_time is not None
-            and self._player.playback_time > self._media_item.intro_start
-            and self._player.playback_time < self._media_item.intro_end):
-
-            if not self.is_in_intro:
-                if settings.skip_intro_always and not self.intro_has_triggered:
-                    self.intro_has_triggered = True
-                    self.skip_intro()
-                    self._player.show_text("Skipped Intro", 3000, 1)
-                elif settings.skip_intro_prompt:
-                    self._player.show_text("Seek to Skip Intro", 3000, 1)
-            self.is_in_intro = True
-        else:
-            self.is_in_intro = False
-
-        # TODO de-duplicate this code in some way - it's ugly
-        if ((settings.skip_credits_always or settings.skip_credits_prompt)
-            and self._media_item is not None and self._media_item.media_type == MediaType.VIDEO and self._media_item.credits_start is not None
-            and self._player.playback_time is not None
-            and self._player.playback_time > self._media_item.credits_start
-            and self._player.playback_time < self._media_item.credits_end):
-
-            if not self.is_in_credits:
-                if settings.skip_credits_always and not self.credits_has_triggered:
-                    self.credits_has_triggered = True
-                    self.skip_credits()
-                    self._player.show_text("Skipped Credits", 3000, 1)
-                elif settings.skip_credits_prompt:
-                    self._player.show_text("Seek to Skip Credits", 3000, 1)
-            self.is_in_credits = True
-        else:
-            self.is_in_credits = False
+    def skip_active_marker(self):
+        for marker_type in SKIPPABLE_MARKER_TYPES:
+            if self.skip_marker(marker_type):
+                return True
+        return False
+
+    def check_markers(self):
+        media_item = self._media_item
+        if media_item is None or media_item.media_type != MediaType.VIDEO:
+            return
+
+        playback_time = self._player.playback_time
+        if playback_time is None:
+            return
+
+        for marker_type, always, prompt, name in SKIPPABLE_MARKERS:
+            marker = None
+            if getattr(settings, always) or getattr(settings, prompt):
+                marker = media_item.markers.find(marker_type, playback_time)
+
+            if marker is None:
+                self.active_markers.pop(marker_type, None)
+            elif self.active_markers.get(marker_type) != marker:
+                self.active_markers[marker_type] = marker
+                if getattr(settings, always) and (marker_type, marker) not in self.triggered_markers:
+                    self.triggered_markers.add((marker_type, marker))
+                    self.skip_marker(marker_type)
+                    self._player.show_text("Skipped {0}".format(name), 3000, 1)
+                elif getattr(settings, prompt):
+                    self._player.show_text("Seek to Skip {0}".format(name), 3000, 1)
+
+        self.schedule_marker_check(media_item, playback_time)
+
+    def schedule_marker_check(self, media_item, playback_time):
+        """
+        Schedules a check right after the next marker boundary if it comes
+        before the next action thread tick, so prompts and skips happen on
+        the marker instead of up to a second later.
+        """
+        self.cancel_marker_check()
+        if self._player.pause:
+            return
+
+        boundary = media_item.markers.next_boundary(playback_time, SKIPPABLE_MARKER_TYPES)
+        if boundary is None or boundary - playback_time > MARKER_CHECK_HORIZON:
+            return
+
+        self.marker_timer = threading.Timer(boundary - playback_time + MARKER_CHECK_SLACK,
+                                            self.trigger_action)
+        self.marker_timer.daemon = True
+        self.marker_timer.start()
+
+    def cancel_marker_check(self):
+        if self.marker_timer is not None:
+            self.marker_timer.cancel()
+            self.marker_timer = None
+
+    def check_prefetch(self):
+        media_item = self._media_item
+        # The decision request for the next item would share the transcode
+        # session of the current one, so don't prefetch during transcodes.
+        if (not settings.prefetch_next or self.prefetch_started or media_item is None
+            or not media_item.parent.has_next or media_item.is_transcode):
+            return
+
+        playback_time = self._player.playback_time
+        duration = self._player.duration
+        if playback_time is None or not duration:
+            return
+
+        prefetch_point = duration * settings.prefetch_percent / 100
+        if media_item.media_type == MediaType.VIDEO and media_item.credits_start is not None:
+            prefetch_point = min(prefetch_point, media_item.credits_start)
+
+        if playback_time >= prefetch_point:
+            self.prefetch_started = True
+            threading.Thread(target=self.prefetch_next, args=(media_item.parent,), daemon=True).start()
+
+    def prefetch_next(self, media):
+        try:
+            log.debug("PlayerManager::prefetch_next loading next item")
+            media.prefetch_next()
+        except Exception:
+            log.warning("PlayerManager::prefetch_next could not load next item", exc_info=True)
+            return
+
+        if settings.gapless_playback:
+            self.put_task(self.queue_next, media)
+
+    @synchronous('_lock')
+    def queue_next(self, media):
+        """
+        Appends the prefetched next item to mpv's playlist, so mpv can
+        preload it and switch to it without a gap.
+        """
+        media_item = self._media_item
+        if (media_item is None or media_item.parent is not media or self.queued_item is not None
+            or not settings.auto_play or media_item.is_transcode or media_item.is_multipart()):
+            return
+
+        # Only queue items that can start without asking the server.
+        next_media = media.next_media
+        next_item = next_media.prepared_item if next_media else None
+        if next_item is None or (next_item.media_type == MediaType.VIDEO and not next_item.get_prefetch_url()):
+            return
+
+        # Check the headers before taking the item, so it stays prepared
+        # for the normal path if it cannot be queued.
+        if get_plex_headers(next_media.server_url) != self.http_headers:
+            return
+
+        next_item = media.get_next().get_media_item(0)
+        url = next_item.get_playback_url()
+
+        log.debug("PlayerManager::queue_next queueing next item for gapless playback")
+        self._player.command("loadfile", url, "append")
+        self.queued_item = next_item
+        self.queued_url = url
+        self.upd_player_hide()
+
+    @synchronous('_lock')
+    def gapless_handoff(self):
+        if self.queued_item is None:
+            return
+
+        media_item, self.url = self.queued_item, self.queued_url
+        self.queued_item = None
+        self.queued_url = None
+        log.debug("PlayerManager::gapless_handoff continuing with next item")
 
+        self._player.command("playlist-remove", 0)
+        if self._media_item:
+            self._media_item.set_played()
+
+        # The file may already be loaded by the time this runs, so poll
+        # for it with a limit instead of waiting for the property to change.
+        deadline = time.monotonic() + HANDOFF_TIMEOUT
+        while self._player.duration is None and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.load_media_item(media_item)
+        self.select_tracks(media_item)
+        self.timeline_handle()
+        if self._finished_lock.locked():
+            self._finished_lock.release()
 
     @synchronous('_lock')
     def update(self):
-        self.check_intro_or_credits()
+        self.check_markers()
+        self.check_prefetch()
         while not self.evt_queue.empty():
             func, args = self.evt_queue.get()
             func(*args)
-        if self._media_item and not self._player.playback_abort:
+        if self._media_item and not self.is_stopped():
             if not self.is_paused():
                 self.last_update.restart()
 
-    def play(self, media_item, offset=0):
+    def play(self, media_item, offset=0, is_current=None):
+        """
+        Plays ``media_item`` from ``offset`` seconds. If ``is_current`` is
+        given, it is checked once the playback decision is made and the
+        item is not played if it returns False. Returns True if the item
+        was sent to mpv.
+        """
+        if media_item.media_type == MediaType.VIDEO:
+            media_item.load_markers()
+
         url = media_item.get_playback_url()
         if not url:        
             log.error("PlayerManager::play no URL found")
-            return
+            return False
+
+        if is_current is not None and not is_current():
+            if media_item.media_type == MediaType.VIDEO:
+                media_item.terminate_transcode()
+            return False
 
         self._play_media(media_item, url, offset)
+        return True
+
+    @contextmanager
+    def batch(self):
+        """
+        Collects the property sets and commands made inside the block and
+        sends them to mpv together when it ends. Blocks nested on the same
+        thread join the outermost batch.
+        """
+        batch = getattr(self._batch, "current", None)
+        if batch is not None:
+            yield batch
+            return
+
+        batch = self._batch.current = CommandBatch(self._player)
+        try:
+            yield batch
+        finally:
+            self._batch.current = None
+        batch.run()
 
     @synchronous('_lock')
     def _play_media(self, media_item, url, offset=0):
@@ -377,48 +715,99 @@ class PlayerManager(object):
         if settings.log_decisions:
             log.debug("Playing: {0}".format(url))
 
-        self._player.play(self.url)
+        plan = StartPlan(media_item, offset)
+        log.debug("PlayerManager::play starting at %s with audio=%s sub=%s"
+                  % (plan.offset, plan.audio, plan.sub))
+        with self.batch() as batch:
+            self.set_http_headers(url)
+            for name, value in plan.get_options().items():
+                batch.set(name, value)
+            batch.command("loadfile", self.url)
+            if self.queued_item is not None:
+                self.queued_item = None
+                self.queued_url = None
+                batch.command("playlist-clear")
+
         self._player.wait_for_property("duration")
-        if settings.fullscreen:
-            self._player.fs = True
-        self._player.force_media_title = media_item.get_proper_title()
-        self._media_item  = media_item
-        self.is_in_intro = False
-        self.is_in_credits = False
-        self.intro_has_triggered = False
-        self.credits_has_triggered = False
-        self.update_subtitle_visuals(False)
-        self.upd_player_hide()
-        self.external_subtitles = {}
-        self.external_subtitles_rev = {}
+        with self.batch() as batch:
+            # These options would otherwise apply to every later file.
+            batch.set("start", "none")
+            batch.set("sub_files", [])
+
+            if settings.fullscreen:
+                batch.set("fs", True)
+            self.load_media_item(media_item)
+
+            if plan.intro is not None:
+                self.triggered_markers.add(("intro", plan.intro))
+            if plan.xsub_id is not None:
+                self.select_start_sub(plan)
+            batch.set("pause", False)
 
         if win_utils:
             win_utils.raise_mpv()
 
-        if offset > 0:
-            self._player.playback_time = offset
+        self.timeline_handle()
+        if self._finished_lock.locked():
+            self._finished_lock.release()
 
+    def select_start_sub(self, plan):
+        """
+        Finds the track of the external subtitle loaded with the item,
+        and selects it if mpv picked another one.
+        """
+        for track in self._player.track_list or []:
+            if track.get("type") == "sub" and track.get("external-filename") == plan.xsub_url:
+                self.external_subtitles[plan.xsub_id] = track["id"]
+                self.external_subtitles_rev[track["id"]] = plan.xsub_id
+                if not track.get("selected"):
+                    with self.batch() as batch:
+                        batch.set("sub", track["id"])
+                return
+
+        log.debug("PlayerManager::play external subtitle was not loaded, adding it")
+        self.load_external_sub(plan.xsub_id)
+
+    def set_http_headers(self, url):
+        headers = get_plex_headers(url)
+        if headers != self.http_headers:
+            with self.batch() as batch:
+                batch.set("http_header_fields", ["{0}: {1}".format(*header) for header in headers.items()])
+            self.http_headers = headers
+
+    def load_media_item(self, media_item):
+        self._media_item  = media_item
+        self.active_markers = {}
+        self.triggered_markers = set()
+        self.cancel_marker_check()
+        self.cancel_seek()
+        self.prefetch_started = False
+        with self.batch() as batch:
+            batch.set("force_media_title", media_item.get_proper_title())
+            self.update_subtitle_visuals(False)
+            self.upd_player_hide()
+        self.external_subtitles = {}
+        self.external_subtitles_rev = {}
+
+    def select_tracks(self, media_item):
         if media_item.media_type == MediaType.VIDEO and not media_item.is_transcode:
             audio_idx = media_item.get_audio_idx()
-            if audio_idx is not None:
-                log.debug("PlayerManager::play selecting audio stream index=%s" % audio_idx)
-                self._player.audio = audio_idx
-
             sub_idx = media_item.get_subtitle_idx()
             xsub_id = media_item.get_external_sub_id()
-            if sub_idx is not None:
-                log.debug("PlayerManager::play selecting subtitle index=%s" % sub_idx)
-                self._player.sub = sub_idx
-            elif xsub_id is not None:
+            with self.batch() as batch:
+                if audio_idx is not None:
+                    log.debug("PlayerManager::play selecting audio stream index=%s" % audio_idx)
+                    batch.set("audio", audio_idx)
+
+                if sub_idx is not None:
+                    log.debug("PlayerManager::play selecting subtitle index=%s" % sub_idx)
+                    batch.set("sub", sub_idx)
+                elif xsub_id is None:
+                    batch.set("sub", "no")
+
+            if sub_idx is None and xsub_id is not None:
                 log.debug("PlayerManager::play selecting external subtitle id=%s" % xsub_id)
                 self.load_external_sub(xsub_id)
-            else:
-                self._player.sub = 'no'
-
-        self._player.pause = False
-        self.timeline_handle()
-        if self._finished_lock.locked():
-            self._finished_lock.release()
 
     def exec_stop_cmd(self):
         if settings.stop_cmd:
@@ -437,6 +826,10 @@ class PlayerManager(object):
             self._media_item.terminate_transcode()
 
         self._media_item  = None
+        self.queued_item = None
+        self.queued_url = None
+        self.cancel_marker_check()
+        self.cancel_seek()
         self._player.command("stop")
         self._player.pause = False
         self.timeline_handle()
@@ -444,12 +837,12 @@ class PlayerManager(object):
         if not playend:
             self.exec_stop_cmd()
 
-    @synchronous('_lock')
     def get_volume(self, percent=False):
-        if self._player:
+        volume = self.state["volume"]
+        if volume is not None:
             if not percent:
-                return self._player.volume / 100
-            return self._player.volume
+                return volume / 100
+            return volume
 
     @synchronous('_lock')
     def toggle_pause(self):
@@ -457,46 +850,130 @@ class PlayerManager(object):
             self._player.pause = not self._player.pause
         self.timeline_handle()
 
-    @synchronous('_lock')
     def seek(self, offset):
         """
-        Seek to ``offset`` seconds
+        Seek to ``offset`` seconds. A single request seeks exactly right
+        away. Requests that follow within ``SEEK_SETTLE``, such as while
+        scrubbing on a remote, are coalesced: the player follows them with
+        keyframe seeks and makes one exact seek to the latest target once
+        the requests settle.
         """
-        if not self._player.playback_abort:
-            if self.is_in_intro and offset > self._player.playback_time:
-                self.skip_intro()
-            elif self.is_in_credits and offset > self._player.playback_time:
-                self.skip_credits()
+        if self.is_stopped():
+            return
+
+        with self.seek_lock:
+            scrubbing = self.seek_target is not None
+
+        if not scrubbing:
+            with self._lock:
+                playback_time = self.get_playback_time()
+                if playback_time is not None and offset > playback_time and self.skip_active_marker():
+                    return
+
+        now = time.monotonic()
+        with self.seek_lock:
+            scrubbing = self.seek_target is not None
+            self.seek_target = offset
+            self.seek_generation += 1
+            fast_seek = False
+            if scrubbing:
+                self.seek_needs_exact = True
+                fast_seek = now - self.last_fast_seek >= SEEK_FAST_INTERVAL
+                if fast_seek:
+                    self.last_fast_seek = now
             else:
-                self._player.playback_time = offset
+                self.seek_needs_exact = False
+
+            if self.seek_timer is not None:
+                self.seek_timer.cancel()
+            self.seek_timer = threading.Timer(SEEK_SETTLE, self.settle_seek, (self.seek_generation,))
+            self.seek_timer.daemon = True
+            self.seek_timer.start()
+
+        if not scrubbing:
+            self._player.command("seek", offset, "absolute+exact")
+        elif fast_seek:
+            self._player.command("seek", offset, "absolute+keyframes")
+        self.timeline_handle()
+
+    def settle_seek(self, generation):
+        with self.seek_lock:
+            if generation != self.seek_generation:
+                return
+            target = self.seek_target
+            needs_exact = self.seek_needs_exact
+
+        # Nothing to do if the only request was already seeked exactly.
+        try:
+            if needs_exact and not self.is_stopped():
+                self._player.command("seek", target, "absolute+exact")
+        except Exception:
+            log.warning("PlayerManager::settle_seek could not seek to %s" % target, exc_info=True)
+
+        with self.seek_lock:
+            if generation == self.seek_generation:
+                self.seek_target = None
+                self.seek_timer = None
         self.timeline_handle()
 
+    def cancel_seek(self):
+        with self.seek_lock:
+            self.seek_generation += 1
+            self.seek_target = None
+            if self.seek_timer is not None:
+                self.seek_timer.cancel()
+                self.seek_timer = None
+
     @synchronous('_lock')
     def set_volume(self, pct):
         if not self._player.playback_abort:
             self._player.volume = pct
         self.timeline_handle()
 
-    @synchronous('_lock')
     def get_state(self):
-        if self._player.playback_abort:
+        if self.state["playback-abort"]:
             return "stopped"
 
-        if self._player.pause:
+        if self.state["pause"]:
             return "paused"
 
         return "playing"
-    
-    @synchronous('_lock')
+
+    def is_stopped(self):
+        return bool(self.state["playback-abort"])
+
     def is_paused(self):
-        if not self._player.playback_abort:
-            return self._player.pause
+        if not self.state["playback-abort"]:
+            return bool(self.state["pause"])
         return False
 
+    def get_playback_time(self):
+        """
+        Returns the playback position, or the target of a seek that is
+        still in progress so the timeline does not jump back and forth.
+        """
+        seek_target = self.seek_target
+        if seek_target is not None:
+            return seek_target
+        return self.state["playback-time"]
+
     @synchronous('_lock')
-    def finished_callback(self, has_lock):
+    def finished_callback(self, has_lock, media_item=None):
         if not self._media_item:
             return
+
+        # The end event was for an item that is no longer playing, such as
+        # when gapless_handoff ran first.
+        if media_item is not None and media_item is not self._media_item:
+            log.debug("PlayerManager::finished_callback item already changed, skipping...")
+            if has_lock:
+                self._finished_lock.release()
+            return
+
+        # mpv is moving on to the queued item, gapless_handoff takes over.
+        if self.queued_item is not None:
+            log.debug("PlayerManager::finished_callback next item is queued, skipping...")
+            return
        
         self._media_item.set_played()
 
@@ -543,14 +1020,18 @@ class PlayerManager(object):
 
     @synchronous('_lock')
     def play_next(self):
+        if self.queued_item is not None:
+            self._play_media(self.queued_item, self.queued_url)
+            return True
+
         if self._media_item.parent.has_next:
             self.play(self._media_item.parent.get_next().get_media_item(0))
             return True
         return False
 
     @synchronous('_lock')
-    def skip_to(self, key):
-        media = self._media_item.parent.get_from_key(key)
+    def skip_to(self, key, item_id=None):
+        media = self._media_item.parent.get_from_key(key, item_id)
         if media:
             self.play(media.get_media_item(0))
             return True
@@ -565,8 +1046,21 @@ class PlayerManager(object):
 
     @synchronous('_lock')
     def restart_playback(self):
-        current_time = self._player.playback_time
-        self.play(self._media_item, current_time)
+        """
+        Plays the current item again from the current position, such as
+        after its quality or streams change. The new stream is prepared
+        while the old one keeps playing, and the old transcode is stopped
+        only once mpv has switched to the new one.
+        """
+        media_item = self._media_item
+        url, old_session = media_item.get_handoff_url(self.get_playback_time() or 0)
+        if not url:
+            log.error("PlayerManager::restart_playback no URL found")
+            return False
+
+        self._play_media(media_item, url, self.get_playback_time() or 0)
+        if old_session is not None:
+            media_item.stop_transcode(old_session)
         return True
 
     @synchronous('_lock')
@@ -577,28 +1071,34 @@ class PlayerManager(object):
 
     @synchronous('_lock')
     def set_streams(self, audio_uid, sub_uid):
-        if not self._media_item.is_transcode:
-            if audio_uid is not None:
-                log.debug("PlayerManager::play selecting audio stream index=%s" % audio_uid)
-                self._player.audio = self._media_item.audio_seq[audio_uid]
-
+        media_item = self._media_item
+        restart = False
+        if media_item.is_transcode:
+            trs_aid, _ = media_item.get_transcode_streams()
+            restart = ((audio_uid is not None and audio_uid != trs_aid) or
+                       (sub_uid is not None and not media_item.can_switch_sub(sub_uid)))
+        elif audio_uid is not None:
+            log.debug("PlayerManager::play selecting audio stream index=%s" % audio_uid)
+            self._player.audio = media_item.audio_seq[audio_uid]
+
+        if not restart:
             if sub_uid == '0':
                 log.debug("PlayerManager::play selecting subtitle stream (none)")
                 self._player.sub = 'no'
             elif sub_uid is not None:
                 log.debug("PlayerManager::play selecting subtitle stream index=%s" % sub_uid)
-                if sub_uid in self._media_item.subtitle_seq:
-                    self._player.sub = self._media_item.subtitle_seq[sub_uid]
+                if sub_uid in media_item.subtitle_seq:
+                    self._player.sub = media_item.subtitle_seq[sub_uid]
                 else:
                     log.debug("PlayerManager::play selecting external subtitle id=%s" % sub_uid)
                     self.load_external_sub(sub_uid)
 
-        self._media_item.set_streams(audio_uid, sub_uid)
+        media_item.set_streams(audio_uid, sub_uid)
 
-        if self._media_item.is_transcode:
+        if restart:
             self.restart_playback()
         self.timeline_handle()
-    
+
     @synchronous('_lock')
     def load_external_sub(self, sub_id):
         if sub_id in self.external_subtitles:
@@ -619,28 +1119,31 @@ class PlayerManager(object):
             return self._media_item.get_transcode_streams()
         else:
             aid, sid = None, None
-            if self._player.sub and self._player.sub != 'no':
-                if self._player.sub in self.external_subtitles_rev:
-                    sid = self.external_subtitles_rev.get(self._player.sub, '')
+            sub, audio = self.state["sid"], self.state["aid"]
+            if sub and sub != 'no':
+                if sub in self.external_subtitles_rev:
+                    sid = self.external_subtitles_rev.get(sub, '')
                 else:
-                    sid = self._media_item.subtitle_uid.get(self._player.sub, '')
+                    sid = self._media_item.subtitle_uid.get(sub, '')
 
-            if self._player.audio != 'no':
-                aid = self._media_item.audio_uid.get(self._player.audio, '')
+            if audio and audio != 'no':
+                aid = self._media_item.audio_uid.get(audio, '')
             return aid, sid
 
     def update_subtitle_visuals(self, restart_transcode=True):
-        if self._media_item.is_transcode:
+        if self._media_item.is_transcode and self._media_item.burn_subs:
             if restart_transcode:
                 self.restart_playback()
         else:
-            self._player.sub_pos = SUBTITLE_POS[settings.subtitle_position]
-            self._player.sub_scale = settings.subtitle_size / 100
-            self._player.sub_color = settings.subtitle_color
+            with self.batch() as batch:
+                batch.set("sub_pos", SUBTITLE_POS[settings.subtitle_position])
+                batch.set("sub_scale", settings.subtitle_size / 100)
+                batch.set("sub_color", settings.subtitle_color)
         self.timeline_handle()
 
     def upd_player_hide(self):
-        self._player.keep_open = self._media_item.parent.has_next
+        with self.batch() as batch:
+            batch.set("keep_open", self._media_item.parent.has_next and self.queued_item is None)
     
     def terminate(self):
         self.stop()
@@ -0,0 +1,98 @@
+"""
+servers.py - Plex Server Registry
+
+Keeps the identity of every Plex server media has been played from, so it
+is fetched once per server instead of once per item. Callers that cannot
+wait on the network (such as the timeline) get whatever is known and the
+lookup continues in the background.
+"""
+import logging
+import threading
+import time
+from threading import Lock
+
+try:
+    from xml.etree import cElementTree as et
+except:
+    from xml.etree import ElementTree as et
+
+from .utils import plex_request, sanitize_msg
+
+log = logging.getLogger('servers')
+
+# Seconds before a known server is refreshed in the background.
+SERVER_REFRESH_INTERVAL = 3600
+# Seconds to wait before trying again after a server could not be loaded.
+SERVER_RETRY_INTERVAL = 30
+
+class PlexServer(object):
+    def __init__(self, url):
+        self.url                = url
+        self.machine_identifier = None
+        self.version            = None
+        self.capabilities       = {}
+        self.updated            = None
+        self.failed             = None
+        self.loaded             = threading.Event()
+        self.loading            = False
+
+    def is_stale(self):
+        now = time.monotonic()
+        if self.failed is not None and now - self.failed < SERVER_RETRY_INTERVAL:
+            return False
+        return self.updated is None or now - self.updated > SERVER_REFRESH_INTERVAL
+
+    def load(self):
+        try:
+            response = plex_request("GET", self.url)
+            response.raise_for_status()
+            root = et.fromstring(response.content)
+            self.machine_identifier = root.get("machineIdentifier")
+            self.version            = root.get("version")
+            self.capabilities       = dict(root.attrib)
+            self.updated            = time.monotonic()
+            self.failed             = None
+            log.debug("PlexServer::load %s is %s (version %s)" % (sanitize_msg(self.url),
+                      self.machine_identifier, self.version))
+        except Exception:
+            self.failed = time.monotonic()
+            log.warning("PlexServer::load could not load %s" % sanitize_msg(self.url), exc_info=True)
+        finally:
+            self.loading = False
+            self.loaded.set()
+
+class ServerRegistry(object):
+    def __init__(self):
+        self.servers = {}
+        self.lock = Lock()
+
+    def get_server(self, url, block=True):
+        """
+        Returns the ``PlexServer`` for ``url``. If the server is not known
+        yet, it is loaded before returning when ``block`` is set, otherwise
+        it is loaded in the background and the returned fields stay empty
+        until it completes. Stale servers are always refreshed in the
+        background.
+        """
+        with self.lock:
+            if url not in self.servers:
+                self.servers[url] = PlexServer(url)
+            server = self.servers[url]
+            start_load = server.is_stale() and not server.loading
+            if start_load:
+                server.loading = True
+
+        if start_load:
+            if block and server.updated is None:
+                server.load()
+            else:
+                threading.Thread(target=server.load, daemon=True).start()
+
+        if block and server.updated is None:
+            server.loaded.wait()
+        return server
+
+    def warm(self, url):
+        self.get_server(url, block=False)
+
+serverRegistry = ServerRegistry()
@@ -5,41 +5,76 @@ Modeled after Plex Home Theater Remote implementation:
     https://github.com/plexinc/plex-home-theater-public/blob/pht-frodo/plex/Remote/
 """
 import logging
-from threading import Event
+import threading
+import time
+from threading import Event, Lock
 
 from .utils import Timer
 
 # give clients 90 seconds before we time them out
 SUBSCRIBER_REMOVE_INTERVAL = 90
+# seconds between checks for subscribers to remove
+SUBSCRIBER_CHECK_INTERVAL = 30
+# subscribers that failed this many sends in a row only get timeline
+# changes, not position updates
+SUBSCRIBER_DEMOTE_FAILURES = 3
+# subscribers that failed this many sends in a row are removed
+SUBSCRIBER_EVICT_FAILURES = 10
+# weight of the newest send in the average latency
+SUBSCRIBER_LATENCY_WEIGHT = 0.2
+# seconds a long poll waits for the next timeline
+POLL_TIMEOUT = 30
 
 log = logging.getLogger('subscribers')
-subscriber_events = {}
 
 class RemoteSubscriberManager(object):
-    subscribers = {}
+    """
+    Keeps the subscribers by uuid. The map is replaced instead of changed
+    in place, so other threads can iterate ``subscribers`` without a lock.
+    """
+    def __init__(self):
+        self.subscribers = {}
+        self.lock = Lock()
 
     def addSubscriber(self, subscriber):
-        if subscriber.uuid in self.subscribers:
-            log.debug("RemoteSubscriberManager::addSubscriber refreshed %s" % subscriber.uuid)
-            self.subscribers[subscriber.uuid].refresh(subscriber)
-        else:
-            log.debug("RemoteSubscriberManager::addSubscriber added %s [%s]" % (subscriber.url, subscriber.uuid))
-            self.subscribers[subscriber.uuid] = subscriber
-
-        # timer.SetTimeout(PLEX_REMOTE_SUBSCRIBER_CHECK_INTERVAL * 1000, this);
+        with self.lock:
+            if subscriber.uuid in self.subscribers:
+                log.debug("RemoteSubscriberManager::addSubscriber refreshed %s" % subscriber.uuid)
+                self.subscribers[subscriber.uuid].refresh(subscriber)
+            else:
+                log.debug("RemoteSubscriberManager::addSubscriber added %s [%s]" % (subscriber.url, subscriber.uuid))
+                subscribers = dict(self.subscribers)
+                subscribers[subscriber.uuid] = subscriber
+                self.subscribers = subscribers
 
     def updateSubscriberCommandID(self, subscriber):
         if subscriber.uuid in self.subscribers:
             self.subscribers[subscriber.uuid].commandID = subscriber.commandID
 
     def removeSubscriber(self, subscriber):
-        if subscriber is not None and subscriber.uuid in self.subscribers:
-            log.debug("RemoteSubscriberManager::removeSubscriber removing subscriber %s [%s]" % (subscriber.url, subscriber.uuid))
-            self.subscribers.pop(subscriber.uuid)
+        with self.lock:
+            if subscriber is not None and subscriber.uuid in self.subscribers:
+                log.debug("RemoteSubscriberManager::removeSubscriber removing subscriber %s [%s]" % (subscriber.url, subscriber.uuid))
+                subscribers = dict(self.subscribers)
+                subscribers.pop(subscriber.uuid)
+                self.subscribers = subscribers
+
+    def removeStaleSubscribers(self):
+        for subscriber in list(self.subscribers.values()):
+            if subscriber.failures:
+                log.debug("RemoteSubscriberManager::removeStaleSubscribers %s [%s] sent %d of %d, "
+                          "latency %.0f ms" % (subscriber.name, subscriber.uuid, subscriber.sent - subscriber.failed,
+                                               subscriber.sent, subscriber.latency * 1e3))
+            if subscriber.shouldRemove():
+                self.removeSubscriber(subscriber)
+            elif subscriber.failures >= SUBSCRIBER_EVICT_FAILURES:
+                log.info("RemoteSubscriberManager::removeStaleSubscribers removing %s [%s] after %d failed sends"
+                         % (subscriber.name, subscriber.uuid, subscriber.failures))
+                self.removeSubscriber(subscriber)
 
     def findSubscriberByUUID(self, uuid):
-        if uuid in self.subscribers:
-            return self.subscribers[uuid]
+        # A single lookup, since the dict may be replaced between two.
+        return self.subscribers.get(uuid)
 
     def getSubscriberURL(self):
         urls = []
@@ -55,6 +90,10 @@ class RemoteSubscriber(object):
         self.url            = ""
         self.name           = name
         self.lastUpdated    = Timer()
+        self.sent           = 0
+        self.failed         = 0
+        self.failures       = 0
+        self.latency        = 0
 
         if ipaddress and protocol:
             self.url = "%s://%s:%s" % (protocol, ipaddress, port)
@@ -65,6 +104,7 @@ class RemoteSubscriber(object):
         if sub.url != self.url:
             log.debug("RemoteSubscriber::refresh new url %s", sub.url)
             self.url = sub.url
+            self.failures = 0
 
         if sub.commandID != self.commandID:
             log.debug("RemoteSubscriber::refresh new commandID %s", sub.commandID)
@@ -72,15 +112,23 @@ class RemoteSubscriber(object):
 
         self.lastUpdated.restart()
 
-    def get_poll_evt(self):
-        if not self.uuid in subscriber_events:
-            subscriber_events[self.uuid] = Event()
-        return subscriber_events[self.uuid]
+    def record_send(self, success, latency):
+        self.sent += 1
+        if success:
+            self.failures = 0
+            if self.latency:
+                self.latency += SUBSCRIBER_LATENCY_WEIGHT * (latency - self.latency)
+            else:
+                self.latency = latency
+        else:
+            self.failed += 1
+            self.failures += 1
+            if self.failures == SUBSCRIBER_DEMOTE_FAILURES:
+                log.info("RemoteSubscriber::record_send %s [%s] is not responding, "
+                         "only sending changes" % (self.name, self.uuid))
 
-    def set_poll_evt(self):
-        if self.uuid in subscriber_events:
-            subscriber_events[self.uuid].set()
-        subscriber_events[self.uuid] = Event()
+    def is_demoted(self):
+        return self.failures >= SUBSCRIBER_DEMOTE_FAILURES
 
     def shouldRemove(self):
         if self.lastUpdated.elapsed() > SUBSCRIBER_REMOVE_INTERVAL:
@@ -92,5 +140,74 @@ class RemoteSubscriber(object):
                   "remove %s because elapsed: %d" % (self.uuid, self.lastUpdated.elapsed()))
         return False
 
+class PollWaiter(object):
+    __slots__ = ("uuid", "commandID", "respond", "expires")
+
+    def __init__(self, uuid, commandID, respond):
+        self.uuid       = uuid
+        self.commandID  = commandID
+        self.respond    = respond
+        self.expires    = time.monotonic() + POLL_TIMEOUT
+
+class PollWaiterRegistry(object):
+    """
+    Long polls waiting for the next timeline. A waiting poll holds no
+    thread, only its socket, which is answered through ``respond`` when a
+    timeline is published or the wait times out.
+    """
+    def __init__(self):
+        self.waiters = {}
+        self.lock = Lock()
+
+    def park(self, request, uuid, commandID, respond):
+        with self.lock:
+            self.waiters[request] = PollWaiter(uuid, commandID, respond)
+
+    def is_parked(self, request):
+        return request in self.waiters
+
+    def release(self, get_xml, uuid=None, expired=False):
+        """
+        Answers the waiting polls with ``get_xml(commandID)``. Only the
+        polls of ``uuid``, or only those that timed out, are answered if
+        requested.
+        """
+        if not self.waiters:
+            return
+
+        now = time.monotonic()
+        with self.lock:
+            released = [request for request, waiter in self.waiters.items()
+                        if (uuid is None or waiter.uuid == uuid) and (not expired or waiter.expires <= now)]
+            released = [self.waiters.pop(request) for request in released]
+
+        for waiter in released:
+            try:
+                waiter.respond(get_xml(waiter.commandID))
+            except Exception:
+                log.warning("PollWaiterRegistry::release error answering %s" % waiter.uuid, exc_info=True)
+
+class SubscriberReaper(threading.Thread):
+    """
+    Removes subscribers that stopped refreshing their subscription or
+    stopped accepting timelines.
+    """
+    def __init__(self):
+        self.halt = Event()
+
+        threading.Thread.__init__(self, name="Subscriber Reaper", daemon=True)
+
+    def stop(self):
+        self.halt.set()
+        self.join()
+
+    def run(self):
+        while not self.halt.wait(SUBSCRIBER_CHECK_INTERVAL):
+            try:
+                remoteSubscriberManager.removeStaleSubscribers()
+            except Exception:
+                log.error("SubscriberReaper::run error removing subscribers", exc_info=True)
 
 remoteSubscriberManager = RemoteSubscriberManager()
+subscriberReaper = SubscriberReaper()
+pollWaiters = PollWaiterRegistry()
@@ -1,4 +1,5 @@
 import logging
+import random
 import requests
 import threading
 import time
@@ -10,17 +11,119 @@ try:
 except:
     from xml.etree import ElementTree as et
 
+from functools import partial
 from io import BytesIO
-from multiprocessing.dummy import Pool
 
 from .conf import settings
 from .media import MediaType
 from .player import playerManager
-from .subscribers import remoteSubscriberManager
+from .subscribers import remoteSubscriberManager, pollWaiters
 from .utils import Timer, safe_urlopen, mpv_color_to_plex
 
 log = logging.getLogger("timeline")
 
+# Seconds a timeline snapshot is reused for requests between ticks.
+SNAPSHOT_MAX_AGE = 1
+# Position updates are sent every second for this many seconds after a seek.
+SEEK_HEARTBEAT_WINDOW = 5
+SEEK_HEARTBEAT = 1
+# Milliseconds the position may drift from the expected one before it is
+# treated as a seek.
+SEEK_THRESHOLD = 2000
+# The heartbeat is this many times slower while paused.
+PAUSED_HEARTBEAT_FACTOR = 4
+# Each heartbeat is moved by up to this fraction of it, so remotes
+# are not all updated at the same moment.
+HEARTBEAT_JITTER = 0.1
+# Seconds to wait before sending again after a failure. This doubles with
+# every failure in a row, up to the maximum.
+SEND_BACKOFF = 1
+SEND_BACKOFF_MAX = 60
+
+SERVER_LANE = "server"
+
+class SenderLane(object):
+    """
+    Sends timelines to one destination from its own thread. Only the newest
+    timeline waits while a send is in progress, so a slow destination gets
+    fewer updates instead of a backlog, and never holds up the others.
+    """
+    def __init__(self, name, send):
+        self.name       = name
+        self.send       = send
+        self.pending    = None
+        self.failures   = 0
+        self.halt       = False
+        self.lock       = Lock()
+        self.trigger    = threading.Event()
+        self.stopped    = threading.Event()
+        self.thread     = threading.Thread(target=self.run, name="Timeline %s" % name, daemon=True)
+        self.thread.start()
+
+    def put(self, snapshot):
+        with self.lock:
+            if self.pending is not None:
+                log.debug("SenderLane::put dropping stale timeline for %s" % self.name)
+            self.pending = snapshot
+        self.trigger.set()
+
+    def stop(self):
+        self.halt = True
+        self.stopped.set()
+        self.trigger.set()
+
+    def run(self):
+        while not self.halt:
+            self.trigger.wait()
+            self.trigger.clear()
+
+            if self.failures:
+                backoff = min(SEND_BACKOFF * 2 ** (self.failures - 1), SEND_BACKOFF_MAX)
+                if self.stopped.wait(backoff):
+                    break
+
+            with self.lock:
+                snapshot, self.pending = self.pending, None
+            if snapshot is None:
+                continue
+
+            if self.send(snapshot):
+                self.failures = 0
+            else:
+                self.failures += 1
+                log.debug("SenderLane::run %d failure(s) sending to %s" % (self.failures, self.name))
+
+class TimelineSnapshot(object):
+    """
+    The timeline at one point in time, serialized once. Subscribers only
+    differ in their commandID, which is spliced into the serialized bytes
+    for each of them.
+    """
+    def __init__(self, timeline):
+        self.timeline = timeline
+        self.created  = time.monotonic()
+
+        mediaContainer = et.Element("MediaContainer")
+        mediaContainer.set("location", timeline["location"])
+
+        lineEl = et.Element("Timeline")
+        for key, value in list(timeline.items()):
+            lineEl.set(key, str(value))
+        mediaContainer.append(lineEl)
+
+        tmp = BytesIO()
+        et.ElementTree(mediaContainer).write(tmp, encoding="utf-8", xml_declaration=True)
+        xmlData = tmp.getvalue()
+
+        split = xmlData.index(b"<MediaContainer") + len(b"<MediaContainer")
+        self.prefix = xmlData[:split]
+        self.suffix = xmlData[split:]
+
+    def get_xml(self, commandID=None):
+        if commandID is None:
+            return self.prefix + self.suffix
+        return b"".join((self.prefix, b' commandID="%d"' % int(commandID), self.suffix))
+
 class TimelineManager(threading.Thread):
     def __init__(self):
         self.currentItems    = {}
@@ -33,15 +136,23 @@ class TimelineManager(threading.Thread):
         self.trigger         = threading.Event()
         self.is_idle         = True
         self.last_media_item = None
-        self.sender_pool     = Pool(5)
-        self.sending_to_ps   = Lock()
+        self.last_snapshot   = None
+        self.last_sent       = None
+        self.next_heartbeat  = 0
+        self.fast_until      = 0
+        self.last_position   = None
+        self.lanes           = {}
+        self.lanes_lock      = Lock()
         self.last_server_url = None
 
         threading.Thread.__init__(self)
 
     def stop(self):
         self.halt = True
-        self.sender_pool.close()
+        with self.lanes_lock:
+            for lane in self.lanes.values():
+                lane.stop()
+            self.lanes.clear()
         self.join()
 
     def run(self):
@@ -49,8 +160,7 @@ class TimelineManager(threading.Thread):
         while not self.halt:
             if (playerManager._player and playerManager._media_item and (not settings.idle_when_paused
                 or not playerManager.is_paused())) or force_next:
-                if not playerManager.is_paused() or force_next:
-                    self.SendTimelineToSubscribers()
+                self.PublishTimeline()
                 self.delay_idle()
             force_next = False
             if self.idleTimer.elapsed() > settings.idle_cmd_delay and not self.is_idle:
@@ -59,6 +169,7 @@ class TimelineManager(threading.Thread):
                 if settings.idle_cmd:
                     os.system(settings.idle_cmd)
                 self.is_idle = True
+            pollWaiters.release(self.GetCurrentTimeLinesXML, expired=True)
             if self.trigger.wait(1):
                 force_next = True
                 self.trigger.clear()
@@ -67,92 +178,156 @@ class TimelineManager(threading.Thread):
         self.idleTimer.restart()
         self.is_idle = False
 
-    def SendTimelineToSubscribers(self):
-        timeline = self.GetCurrentTimeline()
+    def GetSnapshot(self, fresh=False):
+        """
+        Returns the last timeline snapshot, or a new one if it is too old
+        or ``fresh`` is set.
+        """
+        snapshot = self.last_snapshot
+        if fresh or snapshot is None or time.monotonic() - snapshot.created > SNAPSHOT_MAX_AGE:
+            snapshot = TimelineSnapshot(self.GetCurrentTimeline())
+            self.last_snapshot = snapshot
+        return snapshot
+
+    def PublishTimeline(self):
+        """
+        Sends the timeline if anything but the position changed since the
+        last one was sent, or the position jumped, or the heartbeat is due.
+        """
+        snapshot = self.GetSnapshot(fresh=True)
+        timeline = snapshot.timeline
+        now = time.monotonic()
+
+        position = timeline.get("time")
+        if position is not None and self.last_position is not None:
+            # While paused the position should not move at all, so any
+            # change is a seek.
+            jumped = False
+            if timeline["state"] == "playing":
+                jumped = abs(position - self.last_position[0] - (now - self.last_position[1]) * 1e3) > SEEK_THRESHOLD
+            elif timeline["state"] == "paused":
+                jumped = position != self.last_position[0]
+            if jumped:
+                self.fast_until = now + SEEK_HEARTBEAT_WINDOW
+                self.next_heartbeat = now
+        self.last_position = (position, now) if position is not None else None
+
+        unchanged = self.last_sent is not None and self.last_sent == self.get_state_key(timeline)
+        if unchanged and now < self.next_heartbeat:
+            return
+        self.SendTimelineToSubscribers(snapshot, heartbeat=unchanged)
+
+    def get_state_key(self, timeline):
+        return {key: value for key, value in timeline.items() if key != "time"}
+
+    def get_heartbeat(self, state, now):
+        if now < self.fast_until:
+            heartbeat = SEEK_HEARTBEAT
+        elif state == "paused":
+            heartbeat = settings.timeline_heartbeat * PAUSED_HEARTBEAT_FACTOR
+        else:
+            heartbeat = settings.timeline_heartbeat
+        return heartbeat * random.uniform(1 - HEARTBEAT_JITTER, 1 + HEARTBEAT_JITTER)
 
-        # The sender_pool prevents the timeline from freezing
-        # if a client times out or takes a while to respond.
+    def SendTimelineToSubscribers(self, snapshot=None, heartbeat=False):
+        if snapshot is None:
+            snapshot = self.GetSnapshot(fresh=True)
+
+        now = time.monotonic()
+        self.last_sent = self.get_state_key(snapshot.timeline)
+        self.next_heartbeat = now + self.get_heartbeat(snapshot.timeline["state"], now)
+
+        # Each subscriber and the plex server have their own lane, so a
+        # client that times out or takes a while to respond only delays
+        # its own updates. Waiting polls are answered directly. Subscribers
+        # that stopped responding only get changes, not position updates.
 
         log.debug("TimelineManager::SendTimelineToSubscribers updating all subscribers")
-        for sub in list(remoteSubscriberManager.subscribers.values()):
-            self.sender_pool.apply_async(self.SendTimelineToSubscriber, (sub, timeline))
-        
+        pollWaiters.release(snapshot.get_xml)
+        subscribers = remoteSubscriberManager.subscribers
+        for sub in subscribers.values():
+            if sub.url != "" and not (heartbeat and sub.is_demoted()):
+                self.get_lane(sub).put(snapshot)
+
         # Also send timeline to plex server.
-        # Do not send the timeline if the last one if still sending.
-        # (Plex servers can get overloaded... We don't want the UI to freeze.)
-        # Note that we send anyway if the state is stopped. We don't want that to get lost.
-        if self.sending_to_ps.acquire(False) or timeline["state"] == "stopped":
-            self.sender_pool.apply_async(self.SendTimelineToPlexServer, (timeline,))
+        with self.lanes_lock:
+            if SERVER_LANE not in self.lanes:
+                self.lanes[SERVER_LANE] = SenderLane(SERVER_LANE, self.SendTimelineToPlexServer)
+            server_lane = self.lanes[SERVER_LANE]
+
+            for uuid in [uuid for uuid in self.lanes if uuid != SERVER_LANE and uuid not in subscribers]:
+                self.lanes.pop(uuid).stop()
+        server_lane.put(snapshot)
+
+    def get_lane(self, subscriber):
+        with self.lanes_lock:
+            if subscriber.uuid not in self.lanes:
+                send = partial(self.SendLaneTimeline, subscriber.uuid, session=requests.Session())
+                self.lanes[subscriber.uuid] = SenderLane(subscriber.uuid, send)
+            return self.lanes[subscriber.uuid]
+
+    def QueueTimelineForSubscriber(self, subscriber):
+        """
+        Sends the current timeline to ``subscriber`` from its lane.
+        """
+        subscriber = remoteSubscriberManager.findSubscriberByUUID(subscriber.uuid) or subscriber
+        if subscriber.url == "":
+            pollWaiters.release(self.GetSnapshot().get_xml, uuid=subscriber.uuid)
+        else:
+            self.get_lane(subscriber).put(self.GetSnapshot())
 
-    def SendTimelineToPlexServer(self, timeline):
-        try:
-            media_item  = playerManager._media_item
-            server_url = None
-            if media_item:
-                server_url = media_item.parent.server_url
-                self.last_server_url = media_item.parent.server_url
-            elif self.last_server_url:
-                server_url = self.last_server_url
-            if server_url:
-                safe_urlopen("%s/:/timeline" % server_url, timeline, quiet=True)
-        finally:
-            self.sending_to_ps.release()
-
-    def SendTimelineToSubscriber(self, subscriber, timeline=None):
-        subscriber.set_poll_evt()
+    def SendTimelineToPlexServer(self, snapshot):
+        media_item  = playerManager._media_item
+        server_url = None
+        if media_item:
+            server_url = media_item.parent.server_url
+            self.last_server_url = media_item.parent.server_url
+        elif self.last_server_url:
+            server_url = self.last_server_url
+        if server_url:
+            return safe_urlopen("%s/:/timeline" % server_url, snapshot.timeline, quiet=True)
+        return True
+
+    def SendLaneTimeline(self, uuid, snapshot, session=None):
+        # The subscriber is looked up on every send, since it may have
+        # subscribed again with a new URL or commandID since the lane
+        # was created.
+        subscriber = remoteSubscriberManager.findSubscriberByUUID(uuid)
+        if subscriber is None:
+            return True
+        return self.SendTimelineToSubscriber(subscriber, snapshot, session)
+
+    def SendTimelineToSubscriber(self, subscriber, snapshot=None, session=None):
         if subscriber.url == "":
             return True
 
-        timelineXML = self.GetCurrentTimeLinesXML(subscriber, timeline)
+        if snapshot is None:
+            snapshot = self.GetSnapshot()
+        xmlData = snapshot.get_xml(subscriber.commandID)
         url = "%s/:/timeline" % subscriber.url
 
         log.debug("TimelineManager::SendTimelineToSubscriber sending timeline to %s" % url)
 
-        tree = et.ElementTree(timelineXML)
-        tmp  = BytesIO()
-        tree.write(tmp, encoding="utf-8", xml_declaration=True)
-
-        tmp.seek(0)
-        xmlData = tmp.read()
-
         # TODO: Abstract this into a utility function and add other X-Plex-XXX fields
+        started = time.monotonic()
         try:
-            requests.post(url, data=xmlData, headers={
+            (session or requests).post(url, data=xmlData, headers={
                 "Content-Type":             "application/x-www-form-urlencoded",
                 "Connection":               "keep-alive",
                 "Content-Range":            "bytes 0-/-1",
                 "X-Plex-Client-Identifier": settings.client_uuid
             }, timeout=5)
+            subscriber.record_send(True, time.monotonic() - started)
             return True
         except requests.exceptions.ConnectTimeout:
             log.warning("TimelineManager::SendTimelineToSubscriber timeout sending to %s" % url)
-            return False
         except Exception:
             log.warning("TimelineManager::SendTimelineToSubscriber error sending to %s" % url)
-            return False
-
-    def WaitForTimeline(self, subscriber):
-        subscriber.get_poll_evt().wait(30)
-        return self.GetCurrentTimeLinesXML(subscriber)
-
-    def GetCurrentTimeLinesXML(self, subscriber, tlines=None):
-        if tlines is None:
-            tlines = self.GetCurrentTimeline()
-
-        #
-        # Only "video" is supported right now
-        #
-        mediaContainer = et.Element("MediaContainer")
-        if subscriber.commandID is not None:
-            mediaContainer.set("commandID", str(subscriber.commandID))
-        mediaContainer.set("location", tlines["location"])
+        subscriber.record_send(False, time.monotonic() - started)
+        return False
 
-        lineEl = et.Element("Timeline")
-        for key, value in list(tlines.items()):
-            lineEl.set(key, str(value))
-        mediaContainer.append(lineEl)
-
-        return mediaContainer
+    def GetCurrentTimeLinesXML(self, commandID=None):
+        return self.GetSnapshot().get_xml(commandID)
 
     def GetCurrentTimeline(self):
         # https://github.com/plexinc/plex-home-theater-public/blob/pht-frodo/plex/Client/PlexTimelineManager.cpp#L142
@@ -165,11 +340,11 @@ class TimelineManager(threading.Thread):
         controllable = []
 
         media_item  = playerManager._media_item
-        player = playerManager._player
+        playback_time = playerManager.get_playback_time()
 
         # The playback_time value can take on the value of none, probably
         # when playback is complete. This avoids the thread crashing.
-        if media_item and not player.playback_abort and player.playback_time:
+        if media_item and not playerManager.is_stopped() and playback_time:
             self.last_media_item = media_item
             media = media_item.parent
 
@@ -180,7 +355,7 @@ class TimelineManager(threading.Thread):
                 options["type"]          = "video"
                 options["location"]      = "fullScreenMusic"
 
-            options["time"]              = int(player.playback_time * 1e3)
+            options["time"]              = int(playback_time * 1e3)
             options["autoPlay"]          = '1' if settings.auto_play else '0'
             
             aid, sid = playerManager.get_track_ids()
@@ -206,9 +381,13 @@ class TimelineManager(threading.Thread):
             options["address"]           = media.path.hostname
             options["protocol"]          = media.path.scheme
             options["port"]              = media.path.port
-            options["machineIdentifier"] = media.get_machine_identifier()
             options["seekRange"]         = "0-%s" % options["duration"]
 
+            # The server identity is loaded in the background if it isn't known yet.
+            machine_identifier = media.get_machine_identifier(block=False)
+            if machine_identifier:
+                options["machineIdentifier"] = machine_identifier
+
             if media.play_queue:
                 options.update(media.get_queue_info())
 
@@ -247,7 +426,7 @@ class TimelineManager(threading.Thread):
                 options["containerKey"]      = media_item.get_attr("key")
                 if media_item.parent.play_queue:
                     options.update(media_item.parent.get_queue_info())
-            if player.playback_abort:
+            if playerManager.is_stopped():
                 options["state"] = "stopped"
             else:
                 options["state"] = "buffering"
@@ -8,10 +8,15 @@ import uuid
 import re
 import sys
 import ssl
+import time
+import threading
+import requests
 
 from .conf import settings
 from datetime import datetime
 from functools import wraps
+from threading import Lock
+from requests.adapters import HTTPAdapter
 
 PLEX_TOKEN_RE = re.compile("(token|X-Plex-Token)=[^&]*")
 
@@ -19,6 +24,27 @@ log = logging.getLogger("utils")
 plex_eph_tokens = {}
 plex_sessions = {}
 plex_transcode_sessions = {}
+plex_identities = {}
+
+# Settings that are part of the identity sent to Plex servers.
+IDENTITY_SETTINGS = ("client_uuid", "player_name", "client_profile", "plex_identity_headers")
+
+# Keep-alive connections kept open per Plex server.
+HTTP_POOL_SIZE = 4
+
+tls_context = None
+http_sessions = {}
+http_sessions_lock = Lock()
+
+# Seconds to remember if a server is local, or that the lookup failed.
+DNS_CACHE_TTL = 600
+DNS_NEGATIVE_TTL = 60
+# Seconds to wait for a lookup that is already running before assuming remote.
+DNS_LOOKUP_WAIT = 2
+
+local_domains = {}
+local_domain_lookups = {}
+local_domains_lock = Lock()
 
 class Timer(object):
     def __init__(self):
@@ -53,6 +79,7 @@ def synchronous(tlockname):
 
 def upd_token(domain, token):
     plex_eph_tokens[domain] = token
+    plex_identities.pop(domain, None)
 
 def get_transcode_session(domain, create=True):
     if domain not in plex_transcode_sessions:
@@ -62,6 +89,9 @@ def get_transcode_session(domain, create=True):
         plex_transcode_sessions[domain] = session
     return plex_transcode_sessions[domain]
 
+def set_transcode_session(domain, session):
+    plex_transcode_sessions[domain] = session
+
 def clear_transcode_session(domain):
     if domain in plex_transcode_sessions:
         del plex_transcode_sessions[domain]
@@ -72,51 +102,149 @@ def get_session(domain):
         plex_sessions[domain] = session
     return plex_sessions[domain]
 
-def get_plex_url(url, data=None, quiet=False):
-    if not data:
-        data = {}
+class PlexIdentity(object):
+    """
+    The identity sent with every request to a Plex server, encoded once.
+    It is either appended to URLs or, with ``plex_identity_headers``, sent
+    as headers.
+    """
+    __slots__ = ("query", "headers")
+
+    def __init__(self, domain):
+        identity = {}
+        if domain in plex_eph_tokens:
+            identity["X-Plex-Token"] = plex_eph_tokens[domain]
+        else:
+            log.error("get_plex_url No token for: %s" % domain)
+
+        identity.update({
+            "X-Plex-Version":             "2.0",
+            "X-Plex-Client-Identifier":   settings.client_uuid,
+            "X-Plex-Provides":            "player",
+            "X-Plex-Device-Name":         settings.player_name,
+            "X-Plex-Model":               "RaspberryPI",
+            "X-Plex-Device":              "RaspberryPI",
+            "X-Plex-Session-Identifier":  get_session(domain),
+
+            # Lies
+            "X-Plex-Product":             "Plex MPV Shim",
+            "X-Plex-Platform":            "Plex Home Theater",
+            "X-Plex-Client-Profile-Name": settings.client_profile,
+        })
+
+        if settings.plex_identity_headers:
+            self.query = ""
+            self.headers = identity
+        else:
+            self.query = urllib.parse.urlencode(identity)
+            self.headers = {}
+
+def get_plex_identity(domain):
+    identity = plex_identities.get(domain)
+    if identity is None:
+        identity = plex_identities[domain] = PlexIdentity(domain)
+    return identity
+
+def clear_plex_identities(name, value):
+    if name in IDENTITY_SETTINGS:
+        plex_identities.clear()
+
+settings.add_listener(clear_plex_identities)
 
+def get_plex_headers(url):
+    """
+    Returns the headers that need to be sent with ``url``, which are empty
+    unless ``plex_identity_headers`` is enabled.
+    """
+    return get_plex_identity(urllib.parse.urlsplit(url).hostname).headers
+
+def get_plex_url(url, data=None, quiet=False):
     parsed_url = urllib.parse.urlsplit(url)
-    domain = parsed_url.hostname
 
     if parsed_url.scheme != "https" and not settings.allow_http:
         raise ValueError("HTTP is not enabled in the configuration.")
 
-    if domain in plex_eph_tokens:
-        data.update({
-            "X-Plex-Token": plex_eph_tokens[domain]
-        })
-    else:
-        log.error("get_plex_url No token for: %s" % domain)
-
-    data.update({
-        "X-Plex-Version":             "2.0",
-        "X-Plex-Client-Identifier":   settings.client_uuid,
-        "X-Plex-Provides":            "player",
-        "X-Plex-Device-Name":         settings.player_name,
-        "X-Plex-Model":               "RaspberryPI",
-        "X-Plex-Device":              "RaspberryPI",
-        "X-Plex-Session-Identifier":  get_session(domain),
-
-        # Lies
-        "X-Plex-Product":             "Plex MPV Shim",
-        "X-Plex-Platform":            "Plex Home Theater",
-        "X-Plex-Client-Profile-Name": settings.client_profile,
-    })
+    query = get_plex_identity(parsed_url.hostname).query
+    if data:
+        query = urllib.parse.urlencode(data) + ("&" + query if query else "")
 
     # Kinda ghetto...
     sep = "?"
     if sep in url:
         sep = "&"
 
-    if data:
-        url = "%s%s%s" % (url, sep, urllib.parse.urlencode(data))
+    if query:
+        url = "%s%s%s" % (url, sep, query)
 
-    if not quiet:
+    if not quiet and log.isEnabledFor(logging.DEBUG):
         log.debug("get_plex_url Created URL: %s" % sanitize_msg(url))
 
     return url
 
+class PlexHTTPAdapter(HTTPAdapter):
+    """
+    Transport adapter that hands the shared TLS context to urllib3, so the
+    certificate bundle is loaded into it once instead of for every
+    connection. requests would otherwise point each connection at the
+    default bundle, which urllib3 loads into the context again.
+    """
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["ssl_context"] = get_tls_context()
+        return super().init_poolmanager(*args, **kwargs)
+
+    def cert_verify(self, conn, url, verify, cert):
+        super().cert_verify(conn, url, verify, cert)
+        if verify is True or verify == get_ca_bundle():
+            conn.ca_certs = None
+            conn.ca_cert_dir = None
+
+def get_ca_bundle():
+    # The bundle requests verifies against, so the shared context matches.
+    return os.environ.get("REQUESTS_CA_BUNDLE") or os.environ.get("CURL_CA_BUNDLE") or certifi.where()
+
+def get_tls_context():
+    global tls_context
+    if tls_context is None:
+        bundle = get_ca_bundle()
+        if os.path.isdir(bundle):
+            tls_context = ssl.create_default_context(capath=bundle)
+        else:
+            tls_context = ssl.create_default_context(cafile=bundle)
+    return tls_context
+
+def get_http_session(url):
+    """
+    Returns the keep-alive session for the server hosting ``url``. Requests
+    made through it reuse open connections (and their TLS sessions) instead
+    of doing a fresh TCP and TLS handshake each time.
+    """
+    parsed_url = urllib.parse.urlsplit(url)
+    server = "%s://%s" % (parsed_url.scheme, parsed_url.netloc)
+
+    with http_sessions_lock:
+        if server not in http_sessions:
+            session = requests.Session()
+            adapter = PlexHTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            http_sessions[server] = session
+        return http_sessions[server]
+
+def get_http_timeout():
+    return (settings.http_connect_timeout, settings.http_read_timeout)
+
+def plex_request(method, url, data=None, quiet=False, **kwargs):
+    """
+    Sends a request to a Plex server through the pooled session for that
+    server. ``data`` is added to the query string like ``get_plex_url``.
+    """
+    url = get_plex_url(url, data, quiet)
+    kwargs.setdefault("timeout", get_http_timeout())
+    identity_headers = get_plex_headers(url)
+    if identity_headers:
+        kwargs["headers"] = dict(identity_headers, **(kwargs.get("headers") or {}))
+    return get_http_session(url).request(method, url, **kwargs)
+
 def safe_urlopen(url, data=None, quiet=False):
     """
     Opens a url and returns True if an HTTP 200 code is returned,
@@ -125,21 +253,22 @@ def safe_urlopen(url, data=None, quiet=False):
     if not data:
         data = {}
 
-    url = get_plex_url(url, data, quiet)
-
     try:
-        context = ssl.create_default_context(cafile=certifi.where())
-        page = urllib.request.urlopen(url, context=context)
-        if page.code == 200:
+        page = plex_request("GET", url, data, quiet)
+        if page.status_code == 200:
             return True
-        log.error("Error opening URL '%s': page returned %d" % (sanitize_msg(url),
-                                                                page.code))
+        log.error("Error opening URL '%s': page returned %d" % (sanitize_msg(page.url),
+                                                                page.status_code))
     except Exception as e:
         log.error("Error opening URL '%s':  %s" % (sanitize_msg(url), e))
 
     return False
 
-def is_local_domain(domain):
+def lookup_local_domain(domain):
+    """
+    Resolves ``domain`` and returns if it is a private address, or None if
+    the lookup failed.
+    """
     try:
         return ipaddress.ip_address(socket.gethostbyname(domain)).is_private
     except socket.gaierror as e:
@@ -151,7 +280,61 @@ def is_local_domain(domain):
                 log.warning("Unable to check local/remote for domain (IPv6): %s" % domain, exc_info=True)
         else:
             log.warning("Unable to check local/remote for domain: %s" % domain, exc_info=True)
-        return False
+        return None
+
+def resolve_local_domain(domain):
+    try:
+        is_local = lookup_local_domain(domain)
+        ttl = DNS_NEGATIVE_TTL if is_local is None else DNS_CACHE_TTL
+        with local_domains_lock:
+            local_domains[domain] = (bool(is_local), time.monotonic() + ttl)
+    finally:
+        with local_domains_lock:
+            lookup = local_domain_lookups.pop(domain, None)
+        if lookup:
+            lookup.set()
+
+def get_cached_local_domain(domain):
+    with local_domains_lock:
+        cached = local_domains.get(domain)
+    if cached and cached[1] > time.monotonic():
+        return cached[0]
+
+def warm_local_domain(domain):
+    """
+    Starts resolving ``domain`` in the background so that later calls to
+    ``is_local_domain`` do not wait for DNS.
+    """
+    if not domain or get_cached_local_domain(domain) is not None:
+        return
+
+    with local_domains_lock:
+        if domain in local_domain_lookups:
+            return
+        local_domain_lookups[domain] = threading.Event()
+    threading.Thread(target=resolve_local_domain, args=(domain,), daemon=True).start()
+
+def is_local_domain(domain):
+    try:
+        return ipaddress.ip_address(domain).is_private
+    except ValueError:
+        pass
+
+    is_local = get_cached_local_domain(domain)
+    if is_local is not None:
+        return is_local
+
+    with local_domains_lock:
+        lookup = local_domain_lookups.get(domain)
+        if lookup is None:
+            local_domain_lookups[domain] = threading.Event()
+
+    if lookup is None:
+        resolve_local_domain(domain)
+    elif not lookup.wait(DNS_LOOKUP_WAIT):
+        log.warning("Lookup for domain is slow, assuming remote: %s" % domain)
+
+    return bool(get_cached_local_domain(domain))
 
 def sanitize_msg(text):
     if settings.sanitize_output:
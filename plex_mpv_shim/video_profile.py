@@ -101,33 +101,36 @@ class VideoProfileManager:
             for shader in profile.get("shaders", []):
                 shaders_to_apply.append(os.path.join(self.shader_pack, "shaders", shader))
 
-            # Apply Settings
-            already_set = set()
-            for key, value in settings_to_apply:
-                if (key, value) in already_set:
-                    continue
-                log.debug("Set MPV setting {0} to {1}".format(key, value))
-                setattr(self.playerManager._player, key, value)
-                already_set.add((key, value))
-
-            # Apply Shaders
-            log.debug("Set shaders: {0}".format(shaders_to_apply))
-            self.playerManager._player.glsl_shaders = shaders_to_apply
+            with self.playerManager.batch() as batch:
+                # Apply Settings
+                already_set = set()
+                for key, value in settings_to_apply:
+                    if (key, value) in already_set:
+                        continue
+                    log.debug("Set MPV setting {0} to {1}".format(key, value))
+                    batch.set(key, value)
+                    already_set.add((key, value))
+
+                # Apply Shaders
+                log.debug("Set shaders: {0}".format(shaders_to_apply))
+                batch.set("glsl_shaders", shaders_to_apply)
+            if batch.failures:
+                raise MPVSettingError("MPV rejected {0}".format(
+                    ", ".join("{0} ({1})".format(command[1], error) for command, error in batch.failures)))
             self.current_profile = profile_name
             return True
         except MPVSettingError as ex:
             log.error("Could not apply shader profile.", exc_info=1)
+            # Don't leave a partially applied profile active.
+            self.unload_profile()
             return False
 
     def unload_profile(self):
         log.info("Unloading shader profile.")
-        self.playerManager._player.glsl_shaders = []
-        for setting in self.used_settings:
-            try:
-                value = self.defaults[setting]
-                setattr(self.playerManager._player, setting, value)
-            except Exception:
-                log.warning("Default setting {0} value {1} is invalid.".format(setting, value))
+        with self.playerManager.batch() as batch:
+            batch.set("glsl_shaders", [])
+            for setting in self.used_settings:
+                batch.set(setting, self.defaults[setting])
         self.current_profile = None
 
     def menu_handle(self):